@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""
+    Helpers shared by the benchmarks
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Timing and peak memory, measured the same way in every script.
+"""
+import sys
+import resource
+from time import time
+
+
+def timed(func, *args, **kwargs):
+    """Call `func` with the arguments. Returns seconds taken and result."""
+    start = time()
+    result = func(*args, **kwargs)
+    return time() - start, result
+
+
+def peak_rss():
+    """Return the most memory this process has used so far, in megabytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1048576.0 # Bytes
+    return rss / 1024.0 # Kilobytes
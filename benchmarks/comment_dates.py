@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+    Time dating deleted comments, and check the dates given
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Makes a synthetic journal of comments posted a minute apart, with runs
+    of them deleted, and dates the deleted ones with CommentInfo.guess_times
+    and with the pass over neighbouring comments that it replaces. Since the
+    comments are evenly spaced, guess_times should find every deleted
+    comment's true date. Run from the repository root with Zine
+    importable::
+
+        python benchmarks/comment_dates.py [comments]
+"""
+import os
+import sys
+import random
+from datetime import datetime, timedelta
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytz import UTC
+from livejournal_importer import CommentInfo, COMMENT_MODERATED
+
+#: Comments are posted this many seconds apart, from this date
+SPACING = 60
+START = UTC.localize(datetime(2005, 1, 1))
+
+#: Chance that a comment starts a run of deleted ones, and the longest run
+DELETED = 0.02
+LONGEST_RUN = 50
+
+
+class Journal(object):
+    """
+    Dates of `count` comments, None for the deleted ones. The first and
+    last comments are never deleted, so every deleted one has a date to go
+    by on either side.
+    """
+
+    def __init__(self, count, seed=0):
+        rnd = random.Random(seed)
+        self.dates = []
+        deleting = 0
+        for counter in range(count):
+            if counter and not deleting and rnd.random() < DELETED:
+                deleting = rnd.randint(1, LONGEST_RUN)
+            if deleting and counter < count - 1:
+                self.dates.append(None)
+                deleting -= 1
+            else:
+                self.dates.append(START + timedelta(seconds=SPACING * counter))
+
+    def true_date(self, c_id):
+        return START + timedelta(seconds=SPACING * (c_id - 1))
+
+
+class Dated(object):
+    """Stands in for a Comment."""
+    __slots__ = ('pub_date',)
+
+    def __init__(self, pub_date):
+        self.pub_date = pub_date
+
+
+def with_neighbours(journal):
+    """Date deleted comments the way the importer used to."""
+    comments = dict([(c_id + 1, Dated(pub_date))
+                     for c_id, pub_date in enumerate(journal.dates)])
+    start = time()
+    sortedcomments = comments.keys()
+    sortedcomments.sort()
+    totalcomments = len(sortedcomments)
+    for counter in range(totalcomments):
+        comment = comments[sortedcomments[counter]]
+        if comment.pub_date is None:
+            prev_time = comments[sortedcomments[max(0, counter-1)]].pub_date
+            next_time = comments[sortedcomments[min(totalcomments-1,
+                                                    counter+1)]].pub_date
+            new_time = None
+            if next_time is None:
+                new_time = prev_time
+            elif prev_time is None:
+                new_time = next_time
+            else:
+                new_time = prev_time + (next_time - prev_time)/2
+            comment.pub_date = new_time
+    elapsed = time() - start
+    return elapsed, dict([(c_id, comment.pub_date)
+                 for c_id, comment in comments.items()])
+
+
+def with_guess_times(journal):
+    """Date deleted comments with CommentInfo.guess_times."""
+    c_info = CommentInfo({})
+    for c_id, pub_date in enumerate(journal.dates):
+        c_info.add(c_id + 1, 0, COMMENT_MODERATED)
+        c_info.set_postid(c_id + 1, 1)
+        c_info.set_time(c_id + 1, pub_date)
+    start = time()
+    c_info.guess_times()
+    elapsed = time() - start
+    return elapsed, dict([(c_id, c_info.time(c_id)) for c_id in c_info.ids()])
+
+
+def errors(journal, dates):
+    """Return how many deleted comments were left undated or misdated."""
+    undated = misdated = 0
+    for c_id, pub_date in enumerate(journal.dates):
+        c_id += 1
+        if pub_date is not None:
+            assert dates[c_id] == pub_date, 'Comment %d was redated' % c_id
+        elif dates[c_id] is None:
+            undated += 1
+        elif dates[c_id] != journal.true_date(c_id):
+            misdated += 1
+    return undated, misdated
+
+
+def main(count=1000000):
+    journal = Journal(count)
+    deleted = journal.dates.count(None)
+    print '%d comments, %d of them deleted' % (count, deleted)
+    elapsed, dates = with_neighbours(journal)
+    print 'Neighbours:   %7.3fs, %d undated, %d misdated' % (
+        (elapsed,) + errors(journal, dates))
+    elapsed, dates = with_guess_times(journal)
+    undated, misdated = errors(journal, dates)
+    print 'guess_times:  %7.3fs, %d undated, %d misdated' % (
+        elapsed, undated, misdated)
+    assert not undated and not misdated, 'guess_times got dates wrong'
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
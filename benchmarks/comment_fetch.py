@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+    Time downloading comment bodies one page at a time and ahead of time
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Serves a synthetic journal's export_comments.bml from a local HTTP
+    server that takes `latency` seconds to answer each page, and reads all
+    the comment bodies through the LiveJournal importer with one and with
+    several pages downloading at once. Every comment read is checked
+    against the journal, and threaded under its post the way the importer
+    does it, so pages put together out of order show up as errors. Run
+    from the repository root with Zine importable::
+
+        python benchmarks/comment_fetch.py [comments] [latency]
+"""
+import os
+import sys
+import random
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from cgi import parse_qs
+from datetime import datetime
+from time import sleep
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytz import UTC
+import livejournal_importer
+from livejournal_importer import PageFetcher, RateLimiter, CommentInfo, \
+     LiveJournalImporter, COMMENT_BODY_PAGE, COMMENT_FETCHERS, \
+     COMMENT_MODERATED, COMMENT_DELETED
+from _util import timed
+
+
+class ExportComments(object):
+    """A journal's comments, as export_comments.bml would send them."""
+
+    def __init__(self, count, seed=0):
+        rnd = random.Random(seed)
+        self.comments = []
+        replied = {} # Entry id: ids of the comments on it so far
+        for c_id in range(1, count + 1):
+            jitemid = rnd.randint(1, max(1, count // 20))
+            earlier = replied.setdefault(jitemid, [])
+            self.comments.append(dict(
+                id=c_id,
+                jitemid=jitemid,
+                posterid=rnd.randint(0, 50),
+                parentid=earlier and rnd.random() < 0.5 and
+                         rnd.choice(earlier) or None,
+                state=rnd.random() < 0.05 and 'D' or 'A',
+                subject=rnd.random() < 0.3 and u'Re: comment %d' % c_id or None,
+                body=u'Comment %d says “hello”. ' % c_id * rnd.randint(
+                    1, 20)))
+            earlier.append(c_id)
+
+    def page(self, startid, size):
+        """Return `size` comments from `startid` on. Ids start at 1."""
+        start = max(startid, 1) - 1
+        return self.comments[start:start + size]
+
+    def date(self, c):
+        """Return the date a comment was posted, in UTC."""
+        return datetime(2009, c['id'] % 9 + 1, 10 + c['id'] % 10, 12,
+                        c['id'] % 60)
+
+    def comment_meta(self, startid, size=10000):
+        page = self.page(startid, size)
+        lines = [u'<?xml version="1.0" encoding="utf-8"?>', u'<livejournal>',
+                 u'<maxid>%d</maxid>' % len(self.comments), u'<comments>']
+        for c in page:
+            lines.append(u'<comment id="%d" posterid="%d" state="%s" />' % (
+                c['id'], c['posterid'], c['state']))
+        lines += [u'</comments>', u'<usermaps>']
+        for userid in range(1, 51):
+            lines.append(u'<usermap id="%d" user="user_%d" />' % (userid,
+                                                                   userid))
+        lines += [u'</usermaps>', u'</livejournal>']
+        return u'\n'.join(lines).encode('utf-8')
+
+    def comment_body(self, startid, size=COMMENT_BODY_PAGE):
+        page = self.page(startid, size)
+        lines = [u'<?xml version="1.0" encoding="utf-8"?>', u'<livejournal>',
+                 u'<comments>']
+        for c in page:
+            attrs = u'id="%d" jitemid="%d" posterid="%d"' % (
+                c['id'], c['jitemid'], c['posterid'])
+            if c['parentid']:
+                attrs += u' parentid="%d"' % c['parentid']
+            if c['state'] == 'D':
+                lines.append(u'<comment %s state="D" />' % attrs)
+                continue
+            lines.append(u'<comment %s>' % attrs)
+            if c['subject']:
+                lines.append(u'<subject>%s</subject>' % escape(c['subject']))
+            lines.append(u'<body>%s</body>' % escape(c['body']))
+            lines.append(u'<date>%s</date>' % self.date(c).strftime(
+                '%Y-%m-%dT%H:%M:%SZ'))
+            lines.append(u'<property name="poster_ip">10.0.0.%d</property>' %
+                         (c['id'] % 250))
+            lines.append(u'</comment>')
+        lines += [u'</comments>', u'</livejournal>']
+        return u'\n'.join(lines).encode('utf-8')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(journal, latency):
+    """
+    Start serving `journal` on a free local port. Returns the server, with
+    the URL of its export_comments.bml as `comments_url`.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path, query = (self.path.split('?', 1) + [''])[:2]
+            args = parse_qs(query)
+            get = args.get('get', [''])[0]
+            if get not in ('comment_meta', 'comment_body'):
+                self.send_error(404)
+                return
+            sleep(latency)
+            data = getattr(journal, get)(int(args.get('startid', ['0'])[0]))
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    server.comments_url = 'http://127.0.0.1:%d/export_comments.bml' % \
+                                                    server.server_address[1]
+    return server
+
+
+def read_bodies(journal, concurrency, url):
+    """
+    Read every comment body from the export_comments.bml at `url` with
+    `concurrency` downloads at a time, and no limit on how often they start.
+    Returns the CommentInfo and the comments as {id: (post id, Comment)}.
+    """
+    c_info = CommentInfo({})
+    c_info.add_users(dict([(userid, u'user_%d' % userid)
+                           for userid in range(1, 51)]))
+    for c in journal.comments:
+        c_info.add(c['id'], c['posterid'], c['state'] == 'D' and
+                   COMMENT_DELETED or COMMENT_MODERATED)
+    importer = LiveJournalImporter.__new__(LiveJournalImporter)
+    fetcher = PageFetcher({}, concurrency, RateLimiter(
+        rate=1000, max_rate=1000, burst=concurrency))
+    comments = {}
+    c_startids = c_info.ids()[::COMMENT_BODY_PAGE]
+    pages = fetcher.fetch_all([livejournal_importer.comments_url(
+        'comment_body', c_startid, base=url) for c_startid in c_startids])
+    for page in pages:
+        comments.update(importer._read_comment_bodies(page, c_info))
+    return c_info, comments
+
+
+def check_bodies(journal, comments):
+    """
+    Return the ids of comments missing from `comments`, as read_bodies
+    returns them, or not as the journal has them: on the wrong post, with
+    the wrong parent, state, subject, body, date or address.
+    """
+    wrong = []
+    for c in journal.comments:
+        if c['id'] not in comments:
+            wrong.append(c['id'])
+            continue
+        postid, comment = comments[c['id']]
+        if c['state'] == 'D':
+            expected = (COMMENT_DELETED, u'', None, None)
+        else:
+            body = c['body']
+            if c['subject']:
+                body = u'<span class="subject">%s</span>\n%s' % (
+                    c['subject'], body)
+            expected = (COMMENT_MODERATED, body,
+                        UTC.localize(journal.date(c)),
+                        u'10.0.0.%d' % (c['id'] % 250))
+        if postid != c['jitemid'] or comment.parent != c['parentid'] or \
+                (comment.status, comment.body, comment.pub_date,
+                 comment.remote_addr) != expected:
+            wrong.append(c['id'])
+    return wrong
+
+
+class Entry(object):
+    """Stands in for a Post."""
+    pub_date = None
+
+
+class CommentSpool(object):
+    """Stands in for a BlogSpool holding only comments."""
+
+    def __init__(self, comments):
+        self.by_post = {}
+        for c_id in sorted(comments):
+            postid, comment = comments[c_id]
+            self.by_post.setdefault(postid, []).append((c_id, comment))
+
+    def post(self, postid):
+        return Entry()
+
+    def comments(self, postid):
+        return self.by_post[postid]
+
+
+def check_threads(journal, c_info, comments):
+    """
+    Thread the comments that read_bodies returns under their posts with the
+    importer, and return the ids of comments not on their post or without
+    the parent the journal gives them. Threading puts each comment's
+    parent in place of its id, so check_bodies must come first.
+    """
+    importer = LiveJournalImporter.__new__(LiveJournalImporter)
+    spool = CommentSpool(comments)
+    threads = {} # Post id: ids of the Comment objects on it
+    for postid in spool.by_post:
+        post = importer._spooled_post(spool, c_info, postid)
+        threads[postid] = set([id(comment) for comment in post.comments])
+    ids = dict([(id(comment), c_id)
+                for c_id, (postid, comment) in comments.items()])
+    wrong = []
+    for c in journal.comments:
+        comment = comments[c['id']][1]
+        parent = comment.parent
+        if id(comment) not in threads.get(c['jitemid'], ()) or \
+                (parent is not None and
+                 id(parent) not in threads[c['jitemid']]) or \
+                (parent is not None and ids[id(parent)] or None) != \
+                c['parentid']:
+            wrong.append(c['id'])
+    return wrong
+
+
+def main(count=20000, latency=0.5):
+    journal = ExportComments(count)
+    server = serve(journal, latency)
+    print '%d comments in pages of %d, %.2fs per page' % (
+        count, COMMENT_BODY_PAGE, latency)
+    results = {}
+    for concurrency in (1, COMMENT_FETCHERS):
+        results[concurrency], (c_info, comments) = timed(
+            read_bodies, journal, concurrency, server.comments_url)
+        wrong = check_bodies(journal, comments)
+        assert not wrong, '%d comments read wrongly, starting with %d' % (
+            len(wrong), wrong[0])
+        wrong = check_threads(journal, c_info, comments)
+        assert not wrong, '%d comments threaded wrongly, starting with %d' % (
+            len(wrong), wrong[0])
+        print '%d at a time: %7.3fs' % (concurrency, results[concurrency])
+    print 'Speedup: %.1fx' % (results[1] / results[COMMENT_FETCHERS])
+
+
+if __name__ == '__main__':
+    main(*[convert(arg) for convert, arg in zip((int, float), sys.argv[1:3])])
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+    A local stand-in for LiveJournal
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Serves a synthetic journal of any size through the parts of LJ.XMLRPC
+    the LiveJournal importer uses (getchallenge, login, getusertags,
+    sessiongenerate, syncitems and getevents) and through
+    export_comments.bml, with an optional delay before each answer and
+    optional 406 faults from getevents. Used by the other benchmarks, or
+    run on its own to import from::
+
+        python benchmarks/fake_livejournal.py [posts] [comments] [latency] [slow_down] [port]
+
+    and set the livejournal_importer/rpc_url and
+    livejournal_importer/comments_url options to the URLs it prints. Any
+    user name and password will do.
+"""
+import os
+import sys
+import random
+import threading
+import xmlrpclib
+from bisect import bisect_right
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
+from cgi import parse_qs
+from datetime import datetime, timedelta
+from time import sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from livejournal_importer import parse_lj_date
+from comment_fetch import ExportComments
+
+#: LiveJournal sends this many syncitems, and this many events, a call
+SYNCITEMS_PAGE = 500
+GETEVENTS_PAGE = 100
+
+#: Tags and moods the journal's entries use. getusertags leaves out the
+#: last tag, as LiveJournal does with tags deleted after entries used them.
+TAGS = [u'books', u'travel', u'café', u'work', u'photos']
+MOODS = [(1, 'happy'), (2, 'tired'), (3, 'curious')]
+
+
+class FakeJournal(object):
+    """
+    A journal of `posts` entries, a few hours apart, with `comments`
+    comments from ExportComments. Replies are on the same entry as the
+    comment they reply to, as on LiveJournal.
+    """
+
+    def __init__(self, posts, comments, seed=0):
+        rnd = random.Random(seed)
+        eventtime = datetime(2003, 1, 1)
+        self.events = []
+        for itemid in range(1, posts + 1):
+            eventtime += timedelta(seconds=rnd.randint(600, 86400))
+            props = {'taglist': u', '.join(rnd.sample(
+                         TAGS, rnd.randint(0, 2))).encode('utf-8'),
+                     'current_moodid': rnd.choice(MOODS)[0]}
+            if rnd.random() < 0.2:
+                props['current_music'] = u'Sigur Rós'
+            #: Some entries share a sync time, as when several are edited
+            #: at once.
+            if self.events and rnd.random() < 0.1:
+                synctime = parse_lj_date(self.events[-1]['synctime'])
+            else:
+                synctime = eventtime + timedelta(seconds=rnd.randint(1, 3600))
+            self.events.append({
+                'itemid': itemid,
+                'subject': rnd.random() < 0.9 and
+                           u'Entry %d, “%s”' % (itemid, rnd.choice(TAGS)) or u'',
+                'event': u'<p>Entry %d went on about things.</p>\n' % itemid *
+                         rnd.randint(1, 30),
+                'eventtime': eventtime.strftime('%Y-%m-%d %H:%M:%S'),
+                'url': 'http://fake.livejournal.com/%d.html' % itemid,
+                'security': rnd.random() < 0.9 and 'public' or 'private',
+                'props': props,
+                'synctime': synctime.strftime('%Y-%m-%d %H:%M:%S')})
+        self.events.sort(key=lambda event: event['synctime'])
+        self.synctimes = [event['synctime'] for event in self.events]
+        self.comments = ExportComments(comments, seed)
+        for c in self.comments.comments:
+            if c['parentid'] and c['parentid'] != c['id']:
+                c['jitemid'] = self.comments.comments[c['parentid'] - 1][
+                                                                    'jitemid']
+            else:
+                c['jitemid'] = rnd.randint(1, max(1, posts))
+
+    def syncitems(self, lastsync=''):
+        start = bisect_right(self.synctimes, lastsync)
+        items = self.events[start:start + SYNCITEMS_PAGE]
+        return {'total': len(self.events) - start, 'count': len(items),
+                'syncitems': [{'item': 'L-%d' % event['itemid'],
+                               'action': 'update',
+                               'time': event['synctime']}
+                              for event in items]}
+
+    def getevents(self, params):
+        if params.get('selecttype') == 'one':
+            events = [event for event in self.events
+                      if event['itemid'] == int(params['itemid'])]
+        else:
+            start = bisect_right(self.synctimes, params['lastsync'])
+            events = self.events[start:start + GETEVENTS_PAGE]
+        return {'events': [self._event(event) for event in events]}
+
+    def _event(self, event):
+        """Return an entry as getevents sends it: text not ASCII is Binary."""
+        item = {}
+        for key, value in event.items():
+            if key == 'props':
+                item[key] = dict([(name, binary(prop))
+                                  for name, prop in value.items()])
+            elif key != 'synctime':
+                item[key] = binary(value)
+        return item
+
+
+def binary(value):
+    """Return text as Binary if it isn't ASCII, as LiveJournal sends it."""
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeError:
+            return xmlrpclib.Binary(value.encode('utf-8'))
+    return value
+
+
+class FakeLiveJournal(object):
+    """
+    Answers LJ.XMLRPC calls about `journal`. Each call waits `latency`
+    seconds, and each getevents call is refused with a 406 fault with the
+    chance `slow_down`.
+    """
+
+    def __init__(self, journal, latency=0.0, slow_down=0.0, seed=0):
+        self.journal = journal
+        self.latency = latency
+        self.slow_down = slow_down
+        self.random = random.Random(seed)
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def dispatch(self, method, params):
+        name = method.split('.')[-1]
+        self.lock.acquire()
+        try:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            refuse = name == 'getevents' and \
+                     self.random.random() < self.slow_down
+        finally:
+            self.lock.release()
+        sleep(self.latency)
+        params = params and params[0] or {}
+        if name == 'getchallenge':
+            return {'challenge': 'c0:1234567890:%d:60:fake' % self.calls[name],
+                    'server_time': 1234567890, 'expire_time': 1234567950,
+                    'auth_scheme': 'c0'}
+        elif name == 'login':
+            return {'fullname': 'Fake Journal', 'userid': 1,
+                    'moods': [{'id': moodid, 'name': mood, 'parent': 0}
+                              for moodid, mood in MOODS],
+                    'usejournals': ['fake_community']}
+        elif name == 'getusertags':
+            return {'tags': [{'name': tag.encode('utf-8'), 'uses': 1}
+                             for tag in TAGS[:-1]]}
+        elif name == 'sessiongenerate':
+            return {'ljsession': 'v1:u1:s1:t0:gfake//1'}
+        elif name == 'syncitems':
+            return self.journal.syncitems(params.get('lastsync', ''))
+        elif name == 'getevents':
+            if refuse:
+                raise xmlrpclib.Fault(406, 'Client error: Too many repeated '
+                                      'queries.')
+            return self.journal.getevents(params)
+        raise xmlrpclib.Fault(201, 'Client error: Unknown method.')
+
+
+class ThreadingXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+def serve(journal, latency=0.0, slow_down=0.0, port=0):
+    """
+    Start serving `journal` on `port`, or a free local port. Returns the
+    server, with the URLs to import from as `rpc_url` and `comments_url`.
+    """
+    fake = FakeLiveJournal(journal, latency, slow_down)
+
+    class Handler(SimpleXMLRPCRequestHandler):
+        rpc_paths = ('/interface/xmlrpc',)
+        protocol_version = 'HTTP/1.1' # Keep connections open
+
+        def do_GET(self):
+            path, query = (self.path.split('?', 1) + [''])[:2]
+            args = parse_qs(query)
+            get = args.get('get', [''])[0]
+            if path != '/export_comments.bml' or \
+                    get not in ('comment_meta', 'comment_body'):
+                self.send_error(404)
+                return
+            sleep(latency)
+            data = getattr(journal.comments, get)(
+                int(args.get('startid', ['0'])[0]))
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingXMLRPCServer(('127.0.0.1', port), Handler,
+                                   logRequests=False, allow_none=True)
+    server._dispatch = fake.dispatch
+    server.fake = fake
+    server.rpc_url = 'http://127.0.0.1:%d/interface/xmlrpc' % \
+                                                    server.server_address[1]
+    server.comments_url = 'http://127.0.0.1:%d/export_comments.bml' % \
+                                                    server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+
+def main(posts=1000, comments=20000, latency=0.0, slow_down=0.0, port=8080):
+    server = serve(FakeJournal(posts, comments), latency, slow_down, port)
+    print 'Serving %d entries and %d comments' % (posts, comments)
+    print 'livejournal_importer/rpc_url: %s' % server.rpc_url
+    print 'livejournal_importer/comments_url: %s' % server.comments_url
+    sys.stdout.flush()
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(*[convert(arg) for convert, arg in
+           zip((int, int, float, float, int), sys.argv[1:6])])
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+    Time a full LiveJournal import from the local stand-in
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Starts fake_livejournal with a synthetic journal in another process and
+    imports everything from it, comments and all, reporting how long that
+    took, what the importer asked of the server and the most memory the
+    import used. The import runs in the given Zine instance for its
+    settings, but keeps its state in a temporary folder and is counted
+    rather than queued, so the instance is left as it was. Run from the
+    repository root with Zine importable::
+
+        python benchmarks/full_import.py <instance> [posts] [comments] [latency] [slow_down]
+"""
+import os
+import re
+import sys
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from zine import setup
+import livejournal_importer
+from livejournal_importer import LiveJournalImporter, CFG_RPC_URL, \
+     CFG_COMMENTS_URL
+from _util import timed, peak_rss
+
+FAKE_LIVEJOURNAL = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'fake_livejournal.py')
+
+
+class BenchmarkApp(object):
+    """The Zine application, with its own endpoints and instance folder."""
+
+    def __init__(self, app, instance_folder, urls):
+        self.app = app
+        self.instance_folder = instance_folder
+        self.cfg = urls
+
+    def __getattr__(self, name):
+        return getattr(self.app, name)
+
+
+class BenchmarkImporter(LiveJournalImporter):
+    """Counts the posts and comments it would queue."""
+
+    def __init__(self, app):
+        LiveJournalImporter.__init__(self, app)
+        self.dumps = self.posts = self.comments = 0
+
+    def enqueue_dump(self, blog):
+        self.dumps += 1
+        self.posts += len(blog.posts)
+        self.comments += sum([len(post.comments) for post in blog.posts])
+
+
+def start_server(posts, comments, latency, slow_down):
+    """Start fake_livejournal. Returns the process and the URLs it serves."""
+    server = subprocess.Popen([sys.executable, FAKE_LIVEJOURNAL, str(posts),
+                               str(comments), str(latency), str(slow_down),
+                               '0'], stdout=subprocess.PIPE)
+    urls = {}
+    while len(urls) < 2:
+        line = server.stdout.readline()
+        if not line:
+            raise RuntimeError('fake_livejournal did not start')
+        if ': ' in line:
+            key, url = line.strip().split(': ', 1)
+            urls[key] = url
+    return server, urls
+
+
+def main(instance, posts=1000, comments=20000, latency=0.0, slow_down=0.0):
+    app = setup(instance)
+    server, urls = start_server(posts, comments, latency, slow_down)
+    state = tempfile.mkdtemp()
+    #: Flash messages go to the session of a request, which we haven't got.
+    livejournal_importer.flash = lambda message, type='info': None
+    try:
+        importer = BenchmarkImporter(BenchmarkApp(app, state, {
+            CFG_RPC_URL: urls[CFG_RPC_URL],
+            CFG_COMMENTS_URL: urls[CFG_COMMENTS_URL]}))
+        print '%d entries and %d comments, %.2fs latency, %d%% refused' % (
+            posts, comments, latency, slow_down * 100)
+        before = peak_rss()
+        elapsed, log = timed(list, importer.import_livejournal('fake', 'fake'))
+    finally:
+        server.terminate()
+        shutil.rmtree(state, True)
+    print 'Imported %d posts and %d comments in %d dumps' % (
+        importer.posts, importer.comments, importer.dumps)
+    print '%.1fs: %.1f posts and %.1f comments a second' % (
+        elapsed, importer.posts / elapsed, importer.comments / elapsed)
+    print 'Memory: %.1f MB at most, %.1f MB more than at the start' % (
+        peak_rss(), peak_rss() - before)
+    for line in log:
+        if line.startswith(u'<p>Made '):
+            print re.sub(r'<[^>]*>', '', line)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    main(sys.argv[1], *[convert(arg) for convert, arg in
+                        zip((int, int, float, float), sys.argv[2:6])])
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+    Stress test URL autodetection in the LiveJournal parser
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Times linkify against the url_re substitution it replaces, on inputs
+    that make url_re backtrack: long runs of text with no tags, with and
+    without '>' characters in them. url_re is only run on the smaller sizes,
+    since it takes quadratic time. Run from the repository root with Zine
+    importable::
+
+        python benchmarks/linkify.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from livejournal_parser import linkify, url_re, _makelinks
+from _util import timed
+
+MEGABYTE = 1024 * 1024
+
+#: Inputs as name: function of size returning text of about that size
+INPUTS = {
+    'plain words': lambda size: (u'lorem ipsum dolor sit amet ' *
+                                 (size // 27 + 1))[:size],
+    'words and urls': lambda size: (u'see http://example.com/page, then ' *
+                                    (size // 34 + 1))[:size],
+    'quoted log': lambda size: (u'> irc> user said something\r' *
+                                (size // 27 + 1))[:size],
+    'arrows only': lambda size: (u'>' * size),
+    'schemes, no terminator': lambda size: (u'http:' * (size // 5 + 1)
+                                            )[:size],
+    }
+
+#: url_re is not run on inputs larger than this
+REGEX_LIMIT = 16 * 1024
+
+
+def main():
+    print '%-24s %10s %12s %12s' % ('input', 'size', 'linkify', 'url_re')
+    for name in sorted(INPUTS):
+        for size in (16 * 1024, 64 * 1024, MEGABYTE):
+            text = INPUTS[name](size)
+            t_linkify, linked = timed(linkify, text)
+            if size <= REGEX_LIMIT:
+                t_regex, expected = timed(
+                    lambda text: url_re.sub(_makelinks, text), text)
+                assert linked == expected, 'linkify output differs: %s' % name
+                regex = '%11.3fs' % t_regex
+            else:
+                regex = '%12s' % 'skipped'
+            print '%-24s %10d %11.3fs %s' % (name, size, t_linkify, regex)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+    Compare LiveJournalParser.parse in a loop against parse_many
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Parses a synthetic set of imported comments, with the repeats that real
+    comment threads have, one at a time and then in a batch. Run from the
+    repository root with Zine importable::
+
+        python benchmarks/parse_many.py [comments] [processes]
+"""
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from livejournal_parser import LiveJournalParser, NullRenderCache, \
+     set_render_cache
+from _util import timed
+
+SNIPPETS = [
+    u'Thanks!',
+    u'LOL',
+    u'<lj user="jace"> was there too.',
+    u'See http://example.com/photos/ for the pictures.',
+    u'I <b>completely</b> agree.\nMore on this later.',
+    u'<i>Quoted text</i>\n\nMy reply, with a <a href="http://example.org/">link</a>.',
+    u'<lj-raw><table><tr><td>table</td></tr></table></lj-raw> and text',
+    ]
+
+
+def make_comments(count, seed=0):
+    rnd = random.Random(seed)
+    comments = []
+    for counter in range(count):
+        if rnd.random() < 0.3:
+            comments.append(rnd.choice(SNIPPETS[:2]))
+        else:
+            comments.append(u'\n'.join([rnd.choice(SNIPPETS) for x in
+                                        range(rnd.randint(1, 6))]) +
+                            u' #%d' % counter)
+    return comments
+
+
+def main(count=5000, processes=4):
+    comments = make_comments(count)
+    parser = LiveJournalParser(app=None)
+    set_render_cache(NullRenderCache())
+
+    t_single, single = timed(lambda: [parser.parse(c, 'comment').to_html()
+                                      for c in comments])
+    t_batch, batch = timed(lambda: [t.to_html() for t in
+                                    parser.parse_many(comments, 'comment')])
+    t_pooled, pooled = timed(lambda: [t.to_html() for t in parser.parse_many(
+        comments, 'comment', processes=processes)])
+
+    assert single == batch == pooled, 'parse_many output differs from parse'
+    print '%d comments' % count
+    print 'parse, one at a time: %7.3fs' % t_single
+    print 'parse_many:           %7.3fs (%.1fx)' % (t_batch, t_single / t_batch)
+    print 'parse_many, %d procs:  %7.3fs (%.1fx)' % (processes, t_pooled,
+                                                    t_single / t_pooled)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
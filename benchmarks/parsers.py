@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmark and regression check for the parser plugins
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Runs the LiveJournal and reStructuredText parsers, and Zine's sanitize
+    step, over a fixed generated corpus. Each case runs in its own process so
+    that its peak memory can be measured. Throughput, p50/p99 latency and
+    peak memory are written as JSON, and compared against a stored baseline
+    if there is one. Run from the repository root with Zine importable::
+
+        python benchmarks/parsers.py [-o results.json] [-b baseline.json]
+                                     [-t threshold] [--save-baseline]
+
+    The exit status is 1 if any case regressed by more than the threshold
+    (a fraction, 0.25 by default) against the baseline. Baselines are only
+    meaningful on the machine they were recorded on, so record one with
+    --save-baseline before making changes.
+"""
+import os
+import sys
+import random
+from optparse import OptionParser
+from subprocess import Popen, PIPE
+from time import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from _util import peak_rss
+
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+#: Each document is parsed this many times, after one warm up round
+ROUNDS = 5
+
+WORDS = (u'the quick brown fox jumps over a lazy dog while journal readers '
+         u'comment on photos from last week \xe9t\xe9 caf\xe9').split()
+
+
+def words(rnd, count):
+    return u' '.join([rnd.choice(WORDS) for x in range(count)])
+
+
+def make_comments(rnd, count=400):
+    """Short comments with the odd link, user tag and line break."""
+    comments = []
+    for x in range(count):
+        parts = [words(rnd, rnd.randint(3, 30))]
+        if rnd.random() < 0.3:
+            parts.append(u'http://example.com/%d/' % x)
+        if rnd.random() < 0.2:
+            parts.append(u'<lj user="user_%d">' % rnd.randint(1, 50))
+        if rnd.random() < 0.3:
+            parts.append(u'<i>%s</i>' % words(rnd, 4))
+        comments.append(u'\n'.join(parts))
+    return comments
+
+
+def make_entries(rnd, count=25):
+    """Long entries of paragraphs and markup, with a cut halfway through."""
+    entries = []
+    for x in range(count):
+        paras = []
+        for y in range(rnd.randint(20, 60)):
+            para = words(rnd, rnd.randint(20, 120))
+            if rnd.random() < 0.3:
+                para += u' <a href="http://example.org/%d">%s</a>' % (
+                    y, words(rnd, 3))
+            if rnd.random() < 0.2:
+                para += u' see http://example.net/%d/%d for more' % (x, y)
+            if rnd.random() < 0.1:
+                para = u'<blockquote>%s</blockquote>' % para
+            paras.append(para)
+        paras.insert(len(paras) // 2, u'<lj-cut text="More">')
+        entries.append(u'\n\n'.join(paras))
+    return entries
+
+
+def make_raw_entries(rnd, count=40):
+    """Entries that are mostly lj-raw tables and embedded HTML."""
+    entries = []
+    for x in range(count):
+        parts = [words(rnd, 30)]
+        for y in range(rnd.randint(5, 15)):
+            rows = u'\n'.join([u'<tr><td>%s</td><td>http://example.com/%d'
+                               u'</td></tr>' % (words(rnd, 5), z)
+                               for z in range(rnd.randint(5, 20))])
+            parts.append(u'<lj-raw>\n<table>\n%s\n</table>\n</lj-raw>' % rows)
+            parts.append(words(rnd, rnd.randint(10, 40)))
+        entries.append(u'\n'.join(parts))
+    return entries
+
+
+def make_rst_documents(rnd, count=25):
+    """reStructuredText with sections, lists and plenty of code blocks."""
+    docs = []
+    for x in range(count):
+        lines = []
+        for y in range(rnd.randint(4, 10)):
+            title = words(rnd, 4)
+            lines += [title, u'=' * len(title), u'', words(rnd, 60), u'']
+            lines += [u'* %s' % words(rnd, 8) for z in range(3)] + [u'']
+            lines += [u'.. sourcecode:: python', u'']
+            for z in range(rnd.randint(5, 30)):
+                lines.append(u'    def func_%d(arg):' % z)
+                lines.append(u'        return arg * %d  # %s' % (
+                    z, words(rnd, 3)))
+            lines += [u'', u'Some ``inline code`` and a literal block::', u'']
+            lines += [u'    $ %s' % words(rnd, 5) for z in range(4)] + [u'']
+        docs.append(u'\n'.join(lines))
+    return docs
+
+
+def livejournal_case(make_corpus, reason):
+    def setup():
+        from livejournal_parser import LiveJournalParser, NullRenderCache, \
+             set_render_cache
+        set_render_cache(NullRenderCache())
+        parser = LiveJournalParser(app=None)
+        return make_corpus(random.Random(0)), lambda text: parser.parse(
+            text, reason)
+    return setup
+
+
+def restructuredtext_case(reason):
+    def setup():
+        import restructuredtext_parser
+        class BenchApplication(object):
+            cfg = {restructuredtext_parser.CFG_HEADER_LEVEL: 3}
+        parser = restructuredtext_parser.ReStructuredTextParser(app=None)
+        def parse(text):
+            # The parser reads its header level from get_application(), and
+            # there is no application here.
+            original = restructuredtext_parser.get_application
+            restructuredtext_parser.get_application = BenchApplication
+            try:
+                return parser.parse(text, reason)
+            finally:
+                restructuredtext_parser.get_application = original
+        return make_rst_documents(random.Random(0)), parse
+    return setup
+
+
+def sanitize_case():
+    def setup():
+        from zine.utils.zeml import parse_html, sanitize
+        from livejournal_parser import htmlize_markup
+        corpus = [u''.join(htmlize_markup(text, 'entry'))
+                  for text in make_entries(random.Random(0))]
+        return corpus, lambda html: sanitize(parse_html(html))
+    return setup
+
+
+#: Benchmark cases as name: function returning corpus and a callable that
+#: parses one document from it
+CASES = {
+    'livejournal/comments': livejournal_case(make_comments, 'comment'),
+    'livejournal/entries': livejournal_case(make_entries, 'entry'),
+    'livejournal/lj-raw': livejournal_case(make_raw_entries, 'entry'),
+    'restructuredtext/code': restructuredtext_case('entry'),
+    'sanitize/entries': sanitize_case(),
+    }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_case(name):
+    """Run one case in this process and return its results."""
+    corpus, func = CASES[name]()
+    memory_before = peak_rss()
+    for text in corpus:
+        func(text)
+    latencies = []
+    start = time()
+    for counter in range(ROUNDS):
+        for text in corpus:
+            doc_start = time()
+            func(text)
+            latencies.append(time() - doc_start)
+    elapsed = time() - start
+    size = sum([len(text) for text in corpus]) * ROUNDS
+    return {
+        'documents': len(latencies),
+        'characters': size,
+        'seconds': elapsed,
+        'docs_per_second': len(latencies) / elapsed,
+        'chars_per_second': size / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_memory_kb': max(0, int((peak_rss() - memory_before) * 1024)),
+        }
+
+
+def run_all(names):
+    """Run each case in a child process and collect the results."""
+    results = {}
+    for name in names:
+        proc = Popen([sys.executable, os.path.abspath(__file__), '--case',
+                      name], stdout=PIPE)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise SystemExit('benchmark case %s failed' % name)
+        results[name] = json.loads(output)
+    return results
+
+
+#: Metrics compared against the baseline, as name: True if higher is better
+COMPARED = {
+    'chars_per_second': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'peak_memory_kb': False,
+    }
+
+#: Peak memory changes smaller than this are noise and never a regression
+MEMORY_SLACK_KB = 1024
+
+
+def regressions(results, baseline, threshold):
+    """Return a list of messages for metrics worse than the baseline."""
+    messages = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in sorted(COMPARED.items()):
+            old = baseline[name][metric]
+            new = results[name][metric]
+            if metric == 'peak_memory_kb' and new - old < MEMORY_SLACK_KB:
+                continue
+            if not old:
+                continue
+            change = (new - old) / float(old)
+            if higher_is_better:
+                change = -change
+            if change > threshold:
+                messages.append('%s: %s went from %.2f to %.2f (%+.0f%%)' % (
+                    name, metric, old, new, (new - old) * 100.0 / old))
+    return messages
+
+
+def main():
+    optparser = OptionParser(usage='%prog [options] [case ...]')
+    optparser.add_option('-o', '--output', help='write results to this file')
+    optparser.add_option('-b', '--baseline', default=DEFAULT_BASELINE,
+                         help='compare against this file [%default]')
+    optparser.add_option('-t', '--threshold', type='float', default=0.25,
+                         help='allowed fractional regression [%default]')
+    optparser.add_option('--save-baseline', action='store_true',
+                         help='store these results as the baseline')
+    optparser.add_option('--case', help='run a single case in this process')
+    options, args = optparser.parse_args()
+
+    if options.case:
+        print json.dumps(run_case(options.case))
+        return 0
+
+    for name in args:
+        if name not in CASES:
+            optparser.error('unknown case %s (have %s)' % (
+                name, ', '.join(sorted(CASES))))
+    results = run_all(args or sorted(CASES))
+
+    print '%-24s %10s %10s %10s %10s' % ('case', 'kchars/s', 'p50 ms',
+                                         'p99 ms', 'peak kB')
+    for name in sorted(results):
+        result = results[name]
+        print '%-24s %10.1f %10.3f %10.3f %10d' % (
+            name, result['chars_per_second'] / 1000, result['p50_ms'],
+            result['p99_ms'], result['peak_memory_kb'])
+
+    dump = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        open(options.output, 'w').write(dump + '\n')
+    if options.save_baseline:
+        open(options.baseline, 'w').write(dump + '\n')
+        print 'Saved baseline to %s' % options.baseline
+        return 0
+
+    if os.path.exists(options.baseline):
+        baseline = json.load(open(options.baseline))
+        messages = regressions(results, baseline, options.threshold)
+        if messages:
+            print 'Regressions against %s:' % options.baseline
+            for message in messages:
+                print '  ' + message
+            return 1
+        print 'No regressions against %s' % options.baseline
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
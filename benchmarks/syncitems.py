@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+    Time working out what to download next from syncitems results
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Replays a synthetic journal's syncitems and getevents paging through the
+    LiveJournal importer's SyncQueue, and through the scans over every item
+    seen that it replaces. The scans take quadratic time, so they are only
+    run on the smaller sizes. Run from the repository root with Zine
+    importable::
+
+        python benchmarks/syncitems.py
+"""
+import os
+import sys
+import random
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from livejournal_importer import SyncQueue, parse_lj_date
+from _util import timed
+
+#: LiveJournal sends this many syncitems, and about this many events, a call
+SYNCITEMS_PAGE = 500
+GETEVENTS_PAGE = 100
+
+#: The scans are not run on journals larger than this
+SCAN_LIMIT = 20000
+
+
+class Journal(object):
+    """Sync items for `count` entries, in time order as syncitems has them."""
+
+    def __init__(self, count, seed=0):
+        rnd = random.Random(seed)
+        synctime = datetime(2003, 1, 1)
+        self.items = []
+        for itemid in range(1, count + 1):
+            synctime += timedelta(seconds=rnd.randint(0, 7200))
+            kind = rnd.random() < 0.1 and 'C' or 'L'
+            self.items.append({'item': '%s-%d' % (kind, itemid),
+                               'time': synctime.strftime('%Y-%m-%d %H:%M:%S')})
+        self.times = [item['time'] for item in self.items]
+        self.entries = [item for item in self.items
+                        if item['item'].startswith('L-')]
+        self.entry_times = [item['time'] for item in self.entries]
+
+    def syncitems(self, lastsync=''):
+        start = bisect_right(self.times, lastsync)
+        return {'total': len(self.items) - start,
+                'syncitems': self.items[start:start + SYNCITEMS_PAGE]}
+
+    def getevents(self, lastsync):
+        start = bisect_right(self.entry_times, lastsync)
+        return {'events': [{'itemid': int(item['item'][2:])} for item in
+                           self.entries[start:start + GETEVENTS_PAGE]]}
+
+
+def with_scans(journal):
+    """Find what to download the way the importer used to."""
+    result = journal.syncitems()
+    sync_items = list(result['syncitems'])
+    sync_total = result['total']
+    while len(sync_items) < sync_total:
+        lastsync = max([parse_lj_date(item['time']) for item in sync_items]
+                      ).strftime('%Y-%m-%d %H:%M:%S')
+        sync_items.extend(journal.syncitems(lastsync)['syncitems'])
+    sync_data = {}
+    for item in sync_items:
+        if item['item'].startswith('L-'):
+            sync_data[int(item['item'][2:])] = {
+                'downloaded': False, 'time': parse_lj_date(item['time'])}
+    lastsyncs = []
+    sync_left = [sync_data[x] for x in sync_data
+                 if sync_data[x]['downloaded'] is False]
+    while sync_left:
+        lastsync = (min([x['time'] for x in sync_left]) - timedelta(seconds=1)
+                    ).strftime('%Y-%m-%d %H:%M:%S')
+        lastsyncs.append(lastsync)
+        for item in journal.getevents(lastsync)['events']:
+            sync_data[item['itemid']]['downloaded'] = True
+        sync_left = [sync_data[x] for x in sync_data
+                     if sync_data[x]['downloaded'] is False]
+    return lastsyncs
+
+
+def with_queue(journal):
+    """Find what to download with a SyncQueue."""
+    queue = SyncQueue()
+    result = journal.syncitems()
+    sync_count = len(result['syncitems'])
+    sync_total = result['total']
+    queue.add_items(result['syncitems'])
+    while sync_count < sync_total:
+        result = journal.syncitems(queue.latest.strftime('%Y-%m-%d %H:%M:%S'))
+        sync_count += len(result['syncitems'])
+        queue.add_items(result['syncitems'])
+    lastsyncs = []
+    lastsync = queue.lastsync()
+    while lastsync is not None:
+        lastsyncs.append(lastsync)
+        for item in journal.getevents(lastsync)['events']:
+            queue.done(item['itemid'])
+        lastsync = queue.lastsync()
+    return lastsyncs
+
+
+def main():
+    print '%10s %10s %12s %12s' % ('items', 'batches', 'SyncQueue', 'scans')
+    for count in (5000, SCAN_LIMIT, 100000):
+        journal = Journal(count)
+        t_queue, lastsyncs = timed(with_queue, journal)
+        if count <= SCAN_LIMIT:
+            t_scans, expected = timed(with_scans, journal)
+            assert lastsyncs == expected, 'SyncQueue asked for other times'
+            scans = '%11.3fs' % t_scans
+        else:
+            scans = '%12s' % 'skipped'
+        print '%10d %10d %11.3fs %s' % (count, len(lastsyncs), t_queue, scans)
+
+
+if __name__ == '__main__':
+    main()
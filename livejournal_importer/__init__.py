@@ -1,11 +1,32 @@
 # -*- coding: utf-8 -*-
 import os.path
 import re
+import sys
+import gzip
+import zlib
+import errno
+import struct
+import socket
+import httplib
+from array import array
+from cStringIO import StringIO
 import xmlrpclib
+from random import uniform
+from tempfile import mkstemp
+from threading import Thread, Lock, Event
+from Queue import Queue
+from heapq import heapify, heappush, heappop
 from werkzeug import url_unquote_plus, escape, unescape
 try: from hashlib import md5
 except ImportError: from md5 import new as md5
-from time import strptime, sleep
+try: import cPickle as pickle
+except ImportError: import pickle
+try: import json
+except ImportError: import simplejson as json
+try: import resource
+except ImportError: resource = None # Not on Windows
+from time import strptime, sleep, time
+from calendar import timegm
 from datetime import date, datetime, timedelta
 from lxml import etree
 from pytz import UTC
@@ -16,11 +37,12 @@ from zine.utils import forms, log
 from zine.utils.validators import ValidationError, check
 from zine.utils.admin import flash
 from zine.utils.http import redirect_to
-from zine.utils.net import urlparse, HTTPHandler
+from zine.utils.net import urlparse, HTTPHandler, NetException
 from zine.utils.text import gen_slug, gen_timestamped_slug
 from zine.models import COMMENT_MODERATED, COMMENT_BLOCKED_USER, \
      COMMENT_DELETED, STATUS_PUBLISHED, STATUS_PROTECTED, STATUS_PRIVATE
 import zine.models
+from zine.plugins.livejournal_parser import journal_url
 
 __version__ = '0.2'
 
@@ -28,7 +50,29 @@ TEMPLATES = os.path.join(os.path.dirname(__file__), 'templates')
 
 LIVEJOURNAL_RPC='http://www.livejournal.com/interface/xmlrpc'
 LIVEJOURNAL_COMMENTS='http://www.livejournal.com/export_comments.bml'
+#: Configuration keys for the above, to import from elsewhere
+CFG_RPC_URL='livejournal_importer/rpc_url'
+CFG_COMMENTS_URL='livejournal_importer/comments_url'
 TIMEOUT=120 # Wait at least two minutes for server to respond
+COMMENT_BODY_PAGE=1000 # LiveJournal sends this many comment bodies at a time
+COMMENT_FETCHERS=3 # Download no more than this many pages at the same time
+POST_BUILDERS=2 # Threads making posts from downloaded entries
+POST_BACKLOG=100 # Entries that may wait for them
+POSTS_PER_DUMP=1000 # Queue imports of more posts than this in parts
+STATE_FOLDER='livejournal_import' # In the instance folder
+
+REQUEST_RATE=1.0 # Requests a second to start with
+MIN_REQUEST_RATE=0.05 # Never slow down to less than one every 20 seconds
+MAX_REQUEST_RATE=4.0 # Never speed up to more than this
+REQUEST_BURST=3 # Requests that may be made at once after a pause
+BACKOFF=2 # Seconds to wait after the first failure, doubling with each
+MAX_BACKOFF=300
+RETRIES=5 # Give up after failing this many times in a row
+
+#: LiveJournal faults that mean we are asking too much, too fast
+SLOW_DOWN_FAULTS=(406,) # Client is making repeated requests
+#: and those that may well not happen again if we wait a bit
+RETRY_FAULTS=(502, 503) # Database unavailable, lock not obtained
 
 IMPORT_JOURNAL=1
 IMPORT_COMMUNITY=2
@@ -42,6 +86,10 @@ SECURITY_PUBLIC=4
 ljuser_re = re.compile(r'''<lj\s+(user|comm)\s*=\s*"?'?(\w+)"?'?\s*>''', re.U | re.I)
 tag_re = re.compile(r'</?(\w+).*?/?>', re.IGNORECASE | re.UNICODE)
 
+#: Entry props kept in the extras of imported posts
+TEXT_PROPS = ('current_music', 'current_mood', 'current_coords',
+              'current_location', 'picture_keyword')
+
 
 def is_valid_lj_user(message=None):
     """
@@ -82,16 +130,263 @@ def url_to_journal(user):
     'http://users.livejournal.com/__hi__/'
     """
     is_valid_lj_user()(None, user)
-    if user.startswith('_') or user.endswith('_'):
-        return 'http://users.livejournal.com/%s/' % user
-    else:
-        return 'http://%s.livejournal.com/' % user.replace('_', '-')
+    return journal_url('user', user)
+
+
+class ServerBusy(IOError):
+    """LiveJournal answered with a server error. Worth trying again later."""
+
+
+class RateLimiter:
+    """
+    Paces the requests an import makes to LiveJournal, through a token
+    bucket that allows `rate` requests a second in bursts of up to `burst`.
+    When LiveJournal pushes back, with a fault, an error or an answer much
+    slower than usual for that kind of request,
+    the rate is halved and requests wait for a jittered backoff that
+    doubles with each failure in a row. Each request that goes through
+    smoothly lets the rate creep back up to `max_rate`. One limiter is
+    shared by all the threads of an import.
+
+    >>> limiter = RateLimiter(rate=100, max_rate=100)
+    >>> limiter.call(lambda x, y: x + y, (40, 2))
+    42
+    >>> limiter.stats['requests'], limiter.stats['retries']
+    (1, 0)
+    """
+    def __init__(self, rate=REQUEST_RATE, max_rate=MAX_REQUEST_RATE,
+                 burst=REQUEST_BURST, backoff=BACKOFF):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.backoff = backoff
+        self.tokens = burst
+        self.updated = time()
+        self.resume_at = 0 # Time before which no request may start
+        self.failures = 0 # In a row
+        self.latency = {} # Moving average of response times by kind
+        self.lock = Lock()
+        self.stats = dict(requests=0, retries=0, refused=0, waits=0,
+                          waited=0.0, rate=rate)
+
+    def call(self, func, args=(), cost=1, kind=None):
+        """
+        Call `func` with `args` once the bucket has `cost` requests to
+        spare, and return what it returns. Response times are compared
+        with earlier ones of the same `kind`. Network errors, whether from
+        sockets, httplib or Zine's HTTP handler, server errors and faults in
+        RETRY_FAULTS are retried up to RETRIES times. Faults
+        in SLOW_DOWN_FAULTS are not, since the request itself is what
+        LiveJournal objects to, but later requests wait longer. Other
+        faults and HTTP client errors, such as a wrong password or a
+        missing page, are raised at once and leave the pace as it was,
+        since asking again won't help.
+
+        >>> limiter = RateLimiter(rate=100, max_rate=100)
+        >>> def refuse():
+        ...     raise xmlrpclib.Fault(101, 'Invalid password')
+        >>> limiter.call(refuse)
+        Traceback (most recent call last):
+        Fault: <Fault 101: 'Invalid password'>
+        >>> limiter.stats['refused'], limiter.stats['rate']
+        (0, 100)
+        >>> errors = [NetException('timed out'), httplib.BadStatusLine('')]
+        >>> def flaky():
+        ...     if errors:
+        ...         raise errors.pop()
+        ...     return 'ok'
+        >>> limiter = RateLimiter(rate=100, max_rate=100, backoff=0)
+        >>> limiter.call(flaky)
+        'ok'
+        >>> limiter.stats['retries'], limiter.stats['refused']
+        (2, 2)
+        """
+        attempt = 0
+        while True:
+            self.wait(cost)
+            start = time()
+            try:
+                result = func(*args)
+            except xmlrpclib.Fault, fault:
+                if fault.faultCode not in RETRY_FAULTS + SLOW_DOWN_FAULTS:
+                    raise
+                self.failed()
+                if fault.faultCode not in RETRY_FAULTS or attempt == RETRIES:
+                    raise
+            except xmlrpclib.ProtocolError, error:
+                if error.errcode < 500:
+                    raise
+                self.failed()
+                if attempt == RETRIES:
+                    raise
+            except IOError, error:
+                if 400 <= (getattr(error, 'code', None) or 0) < 500:
+                    raise # urllib2's HTTPError
+                self.failed()
+                if attempt == RETRIES:
+                    raise
+            except (NetException, httplib.HTTPException):
+                self.failed()
+                if attempt == RETRIES:
+                    raise
+            else:
+                self.succeeded(time() - start, kind)
+                return result
+            attempt += 1
+            self.lock.acquire()
+            try:
+                self.stats['retries'] += 1
+            finally:
+                self.lock.release()
+
+    def wait(self, cost=1):
+        """Wait until `cost` requests may be made."""
+        self.lock.acquire()
+        try:
+            now = time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= cost
+            delay = max(self.resume_at - now, -self.tokens / self.rate, 0)
+            self.stats['requests'] += cost
+            if delay:
+                self.stats['waits'] += 1
+                self.stats['waited'] += delay
+        finally:
+            self.lock.release()
+        if delay:
+            sleep(delay)
+
+    def succeeded(self, seconds, kind=None):
+        self.lock.acquire()
+        try:
+            self.failures = 0
+            latency = self.latency.get(kind, seconds)
+            if seconds > max(1, latency * 3):
+                #: Much slower than usual. The server is struggling.
+                self.rate = max(MIN_REQUEST_RATE, self.rate * 0.75)
+            else:
+                self.rate = min(self.max_rate, self.rate + 0.1)
+            self.latency[kind] = latency * 0.8 + seconds * 0.2
+            self.stats['rate'] = self.rate
+        finally:
+            self.lock.release()
+
+    def failed(self):
+        self.lock.acquire()
+        try:
+            self.rate = max(MIN_REQUEST_RATE, self.rate / 2)
+            backoff = min(MAX_BACKOFF, self.backoff * 2 ** self.failures)
+            self.resume_at = max(self.resume_at,
+                                 time() + backoff * uniform(0.5, 1.5))
+            self.failures += 1
+            self.stats['refused'] += 1
+            self.stats['rate'] = self.rate
+        finally:
+            self.lock.release()
+
+
+class KeepAliveTransport(xmlrpclib.Transport):
+    """
+    XML-RPC transport that keeps its HTTP connection open from one request
+    to the next, instead of connecting afresh each time. Sends `headers`
+    with each request, and counts requests and connections in `stats`.
+    """
+    def __init__(self, secure=False):
+        xmlrpclib.Transport.__init__(self)
+        self.secure = secure
+        self.headers = {}
+        self.host = None
+        self.connection = None
+        self.stats = dict(requests=0, connections=0, bytes=0)
+
+    def request(self, host, handler, request_body, verbose=0):
+        headers = {'Content-Type': 'text/xml', 'User-Agent': self.user_agent}
+        headers.update(self.headers)
+        while True:
+            reused = self.connection is not None and self.host == host
+            if not reused:
+                self.close()
+                if self.secure:
+                    self.connection = httplib.HTTPSConnection(host)
+                else:
+                    self.connection = httplib.HTTPConnection(host)
+                self.host = host
+                self.stats['connections'] += 1
+            #: A connection the server closed while it was idle fails to send,
+            #: or sends and gets closed or reset without a byte in answer.
+            #: Either way the request is sent again on a new connection. Any
+            #: other error, once the request may have been acted on, is
+            #: raised, since calls like sessiongenerate, or login with a
+            #: challenge that can only be used once, must not run twice.
+            try:
+                self.connection.request('POST', handler, request_body,
+                                        headers)
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                if reused:
+                    continue
+                raise
+            try:
+                response = self.connection.getresponse()
+            except (httplib.HTTPException, socket.error), error:
+                self.close()
+                if reused and no_response(error):
+                    continue
+                raise
+            try:
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                raise
+            break
+        self.stats['requests'] += 1
+        self.stats['bytes'] += len(data)
+        if response.will_close:
+            self.close()
+        if response.status != 200:
+            raise xmlrpclib.ProtocolError(host + handler, response.status,
+                                          response.reason, response.msg)
+        parser, unmarshaller = self.getparser()
+        parser.feed(data)
+        parser.close()
+        return unmarshaller.close()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def no_response(error):
+    """
+    Return True if an error waiting for the status line of a response says
+    the server closed or reset the connection without sending a byte.
+
+    >>> no_response(httplib.BadStatusLine(''))
+    True
+    >>> no_response(httplib.BadStatusLine('HTTP/1.1 2OO OK'))
+    False
+    >>> no_response(socket.error(errno.ECONNRESET, 'Connection reset by peer'))
+    True
+    >>> no_response(socket.timeout('timed out'))
+    False
+    """
+    if isinstance(error, httplib.BadStatusLine):
+        return error.line in ('', "''") or \
+               error.line.startswith('No status line received')
+    if isinstance(error, socket.error):
+        return error.errno in (errno.ECONNRESET, errno.EPIPE,
+                               errno.ECONNABORTED)
+    return False
 
 
 class LiveJournalConnect:
     """
     XML-RPC gateway to LiveJournal. Performs a challenge-response authentication
-    before each request.
+    before each request, or after `use_session`, sends the session cookie.
+    Requests are paced by `limiter`.
     """
     # Surely there's a cleaner way to do this using decorators?
     class LiveJournalConnectMethod:
@@ -99,33 +394,37 @@ class LiveJournalConnect:
             self._parent = parent
             self._method = method
 
-        def _pause_for(self, seconds):
-            if not self._parent._lastcalltime:
-                return
-            now = datetime.now()
-            if now > self._parent._lastcalltime:
-                delta = now - self._parent._lastcalltime
-                if delta.days > 0:
-                    return # We're only meant for a few seconds
-                elif delta.seconds >= seconds:
-                    return # Waiting period already passed
-                elif seconds == 1:
-                    return # Sleep can't handle sub-second precision
-                else:
-                    sleep(seconds - delta.seconds)
-
         def __call__(self, **kw):
-            # Don't call API more than once in two seconds.
-            ##self._pause_for(2)
-            challenge = self._parent._server.LJ.XMLRPC.getchallenge()[
+            if self._parent._session:
+                try:
+                    return self._parent._limiter.call(self._call, (kw, True),
+                                                      kind=self._method)
+                except xmlrpclib.Fault, fault:
+                    if not 100 <= fault.faultCode < 200:
+                        raise
+                    #: User errors include not accepting the session. Go
+                    #: back to challenges for the rest of the import.
+                    self._parent.use_session(None)
+            #: Getting a challenge and using it count as two requests. They
+            #: are retried together, since a challenge can only be used once.
+            return self._parent._limiter.call(self._call, (kw, False),
+                                              cost=2, kind=self._method)
+
+        def _call(self, kw, session):
+            if session:
+                parms = {'username': self._parent._user,
+                         'auth_method': 'cookie',
+                         'ver': 1}
+            else:
+                challenge = self._parent._server.LJ.XMLRPC.getchallenge()[
                                                                     'challenge']
-            response = md5(challenge + md5(self._parent._pass).hexdigest()
+                response = md5(challenge + md5(self._parent._pass).hexdigest()
                                                                 ).hexdigest()
-            parms = {'username': self._parent._user,
-                     'auth_method': 'challenge',
-                     'auth_challenge': challenge,
-                     'auth_response': response,
-                     'ver': 1}
+                parms = {'username': self._parent._user,
+                         'auth_method': 'challenge',
+                         'auth_challenge': challenge,
+                         'auth_response': response,
+                         'ver': 1}
             if self._parent._journal:
                 parms['usejournal'] = self._parent._journal
             parms.update(kw)
@@ -133,22 +432,881 @@ class LiveJournalConnect:
                 if isinstance(value, unicode):
                     parms[key] = value.encode('utf-8')
 
-            result = getattr(self._parent._server.LJ.XMLRPC,
-                             self._method)(parms)
-            self._parent._lastcalltime = datetime.now()
-            return result
+            return getattr(self._parent._server.LJ.XMLRPC,
+                           self._method)(parms)
 
-    def __init__(self, username, password, usejournal=None):
-        self._server = xmlrpclib.Server(LIVEJOURNAL_RPC)
+    def __init__(self, username, password, usejournal=None, limiter=None,
+                 url=None):
+        url = url or LIVEJOURNAL_RPC
+        self._transport = KeepAliveTransport(secure=url.startswith('https:'))
+        self._server = xmlrpclib.Server(url, transport=self._transport)
         self._user = username
         self._pass = password
         self._journal = usejournal
-        self._lastcalltime = None
+        self._limiter = limiter or RateLimiter()
+        self._session = None
+        self.stats = self._transport.stats # XML-RPC requests and connections
+
+    def use_session(self, ljsession):
+        """
+        Authenticate with the `ljsession` cookie from sessiongenerate
+        instead of a challenge, so each call is a single request. None
+        goes back to challenges.
+        """
+        #: See http://www.livejournal.com/doc/server/ljp.csp.auth.cookies.html
+        self._session = ljsession
+        if ljsession:
+            self._transport.headers = {'X-LJ-Auth': 'cookie',
+                                       'Cookie': 'ljsession=%s' % ljsession}
+        else:
+            self._transport.headers = {}
 
     def __getattr__(self, method):
         return self.LiveJournalConnectMethod(self, method)
 
 
+def decode_prop(value):
+    """
+    Return a value from an event as unicode. XML-RPC sends text that isn't
+    plain ASCII as Binary.
+
+    >>> decode_prop(xmlrpclib.Binary('caf\\xc3\\xa9'))
+    u'caf\\xe9'
+    >>> decode_prop('Linkin Park')
+    u'Linkin Park'
+    >>> decode_prop(u'Sigur R\\xf3s')
+    u'Sigur R\\xf3s'
+    >>> decode_prop(1)
+    u'1'
+    """
+    if isinstance(value, unicode):
+        return value # xmlrpclib's own decoding of a plain string
+    if isinstance(value, xmlrpclib.Binary):
+        value = value.data
+    return unicode(str(value), 'utf-8')
+
+
+def comments_url(get, startid, usejournal=None, base=None):
+    """
+    Return the URL for a page of comment metadata or bodies, from
+    LiveJournal or the export_comments.bml at `base`.
+
+    >>> comments_url('comment_meta', 0)
+    'http://www.livejournal.com/export_comments.bml?get=comment_meta&startid=0'
+    >>> comments_url('comment_body', 1000, 'community')
+    'http://www.livejournal.com/export_comments.bml?get=comment_body&startid=1000&authas=community'
+    >>> comments_url('comment_meta', 0, base='http://localhost/export.bml')
+    'http://localhost/export.bml?get=comment_meta&startid=0'
+    """
+    #: See http://www.livejournal.com/developer/exporting.bml and
+    #: http://www.livejournal.com/doc/server/ljp.csp.export_comments.html
+    return (base or LIVEJOURNAL_COMMENTS) + '?get=%s&startid=%d%s' % (get,
+        startid, usejournal and '&authas=%s' % usejournal or '')
+
+
+def iter_elements(data, tags):
+    """
+    Parse the XML document in `data` and yield the elements named in `tags`
+    as they are completed. Each element is cleared and removed from the tree
+    once the caller moves on, so the whole tree is never held in memory.
+
+    >>> data = '<a><b n="1"><c/></b><c/><b n="2"/></a>'
+    >>> [element.attrib['n'] for element in iter_elements(data, ('b',))]
+    ['1', '2']
+    """
+    for event, element in etree.iterparse(StringIO(data)):
+        if element.tag in tags:
+            yield element
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+class PageFetcher:
+    """
+    Downloads pages with the given HTTP headers, paced by `limiter`.
+    `fetch_all` keeps up to `concurrency` pages downloading ahead of the
+    one being read, so that reading a page overlaps with fetching the next
+    ones. Pages and bytes downloaded are counted in `stats`.
+    """
+    def __init__(self, headers, concurrency=COMMENT_FETCHERS, limiter=None):
+        self.headers = headers
+        self.concurrency = concurrency
+        self.limiter = limiter or RateLimiter()
+        self.lock = Lock()
+        self.stats = dict(requests=0, bytes=0)
+
+    def fetch(self, url):
+        """Download `url` and return the response body."""
+        #: Metadata and body pages take different times to make.
+        return self.limiter.call(self._fetch, (url,),
+                                 kind=urlparse.urlsplit(url)[3].split('&')[0])
+
+    def _fetch(self, url):
+        conn = HTTPHandler(urlparse.urlsplit(url), timeout=TIMEOUT,
+                           method='GET')
+        conn.headers.extend(self.headers)
+        response = conn.open()
+        self.lock.acquire()
+        try:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += len(response.data)
+        finally:
+            self.lock.release()
+        if response.status >= 500:
+            raise ServerBusy('LiveJournal said %d for %s' % (response.status,
+                                                             url))
+        return response.data
+
+    def fetch_all(self, urls):
+        """Yield the response body for each of `urls`, in order."""
+        urls = iter(urls)
+        pending = []
+        while True:
+            while len(pending) < self.concurrency:
+                try:
+                    url = urls.next()
+                except StopIteration:
+                    break
+                pending.append(self._start(url))
+            if not pending:
+                break
+            thread, result = pending.pop(0)
+            thread.join()
+            if 'error' in result:
+                error_type, error, traceback = result['error']
+                raise error_type, error, traceback
+            yield result['data']
+
+    def _start(self, url):
+        result = {}
+        def run():
+            try:
+                result['data'] = self.fetch(url)
+            except Exception:
+                result['error'] = sys.exc_info()
+        thread = Thread(target=run)
+        thread.setDaemon(True)
+        thread.start()
+        return thread, result
+
+
+class WorkerPool:
+    """
+    Calls `func` on items on `workers` threads. Items wait in a queue of
+    at most `backlog`, so that whatever submits them can't get far ahead of
+    the workers. `submit` returns a job to pass to `result`, which waits
+    for it to finish and returns what `func` returned.
+    """
+    def __init__(self, func, workers=POST_BUILDERS, backlog=POST_BACKLOG):
+        self.func = func
+        self.queue = Queue(backlog)
+        self.threads = []
+        for counter in range(workers):
+            thread = Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, item):
+        job = {'item': item, 'done': Event()}
+        self.queue.put(job)
+        return job
+
+    def result(self, job):
+        job['done'].wait()
+        if 'error' in job:
+            error_type, error, traceback = job['error']
+            raise error_type, error, traceback
+        return job['result']
+
+    def close(self):
+        """Stop the workers once they have finished the jobs they have."""
+        for thread in self.threads:
+            self.queue.put(None)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                job['result'] = self.func(job['item'])
+            except Exception:
+                job['error'] = sys.exc_info()
+            job['done'].set()
+
+
+def peak_rss():
+    """
+    Return the most memory this process has used so far, in megabytes, or
+    None where we can't tell.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1048576.0 # Bytes
+    return rss / 1024.0 # Kilobytes
+
+
+# The Quills importer has the same metrics, since the two plugins are
+# installed on their own. Change both together.
+class ImportMetrics:
+    """
+    Wall time, requests, bytes received and items done in each phase of an
+    import, with the peak memory use at the end of each. Requests and bytes
+    are read from the `stats` of whatever makes them, given to `watch`. A
+    phase started again, as for each page of entries, adds to what it did
+    before.
+
+    >>> stats = dict(requests=0, bytes=0)
+    >>> metrics = ImportMetrics()
+    >>> metrics.watch(stats)
+    >>> metrics.start('login')
+    >>> stats['requests'] += 2; stats['bytes'] += 300
+    >>> metrics.start('tags')
+    >>> stats['requests'] += 1; stats['bytes'] += 1200; metrics.add(40)
+    >>> metrics.start('syncitems')
+    >>> stats['requests'] += 1; stats['bytes'] += 5000; metrics.add(12)
+    >>> metrics.start('getevents')
+    >>> stats['requests'] += 1; stats['bytes'] += 9000; metrics.add(12)
+    >>> metrics.start('syncitems')
+    >>> stats['requests'] += 1; stats['bytes'] += 2000; metrics.add(5)
+    >>> metrics.finish()
+    >>> [(phase['name'], phase['requests'], phase['bytes'], phase['items'])
+    ...  for phase in metrics.phases]
+    [('login', 2, 300, 0), ('tags', 1, 1200, 40), ('syncitems', 2, 7000, 17), ('getevents', 1, 9000, 12)]
+    """
+    def __init__(self):
+        self.sources = []
+        self.phases = []
+        self.current = None
+
+    def watch(self, stats):
+        self.sources.append(stats)
+        if self.current is not None:
+            #: Only what it does from now on counts towards this phase.
+            self.current['requests'] -= stats['requests']
+            self.current['bytes'] -= stats['bytes']
+
+    def start(self, name):
+        """Finish the phase under way, if any, and start the next."""
+        self.finish()
+        requests, bytes = self._totals()
+        self.current = {'name': name, 'started': time(), 'items': 0,
+                        'requests': -requests, 'bytes': -bytes}
+
+    def add(self, items=1):
+        """Count items done in the phase under way."""
+        self.current['items'] += items
+
+    def finish(self):
+        phase = self.current
+        if phase is None:
+            return
+        requests, bytes = self._totals()
+        phase['seconds'] = time() - phase.pop('started')
+        phase['requests'] += requests
+        phase['bytes'] += bytes
+        for earlier in self.phases:
+            if earlier['name'] == phase['name']:
+                for key in ('seconds', 'requests', 'bytes', 'items'):
+                    earlier[key] += phase[key]
+                phase = earlier
+                break
+        else:
+            self.phases.append(phase)
+        phase['items_per_second'] = phase['seconds'] and \
+                                    phase['items'] / phase['seconds'] or 0.0
+        phase['peak_rss'] = peak_rss()
+        self.current = None
+
+    def table(self):
+        """Return the phases as lines of an HTML table for the log."""
+        lines = [_(u'<table class="import-metrics">'),
+                 _(u'<tr><th>Phase</th><th>Time</th><th>Requests</th>'\
+                   u'<th>Received</th><th>Items</th><th>Items/s</th>'\
+                   u'<th>Peak memory</th></tr>')]
+        for phase in self.phases + [self._total()]:
+            if phase['items'] is None:
+                items = rate = u'-'
+            else:
+                items = u'%d' % phase['items']
+                rate = u'%.1f' % phase['items_per_second']
+            if phase['peak_rss'] is None:
+                memory = u'-'
+            else:
+                memory = u'%.1f MB' % phase['peak_rss']
+            lines.append(u'<tr><td>%s</td><td>%.1fs</td><td>%d</td>'\
+                         u'<td>%.1f kB</td><td>%s</td><td>%s</td>'\
+                         u'<td>%s</td></tr>' % (phase['name'],
+                phase['seconds'], phase['requests'], phase['bytes'] / 1024.0,
+                items, rate, memory))
+        lines.append(u'</table>')
+        return lines
+
+    def save(self, path):
+        """Write the phases and their total to `path` as JSON."""
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        f = open(path, 'w')
+        try:
+            json.dump({'phases': self.phases, 'total': self._total()}, f,
+                      indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    def _total(self):
+        total = {'name': _(u'Total'), 'seconds': 0.0, 'requests': 0,
+                 'bytes': 0, 'items': None, 'items_per_second': None,
+                 'peak_rss': peak_rss()}
+        for phase in self.phases:
+            for key in ('seconds', 'requests', 'bytes'):
+                total[key] += phase[key]
+        return total
+
+    def _totals(self):
+        requests = bytes = 0
+        for stats in self.sources:
+            requests += stats['requests']
+            bytes += stats['bytes']
+        return requests, bytes
+
+
+class TagRegistry:
+    """
+    The tags and categories of an import, made once each and shared by
+    every post that has them. A tag that getusertags left out is made when
+    a post first has it. Posts are made on several threads, so new ones
+    are made under a lock.
+
+    >>> registry = TagRegistry([u'travel'])
+    >>> tags = registry.taglist('travel, food,, travel , ')
+    >>> [tag.name for tag in tags]
+    [u'travel', u'food']
+    >>> tags[0] is registry.tag(u'travel'), len(registry.tags)
+    (True, 2)
+    >>> registry.category(u'Journal') is registry.category(u'Journal')
+    True
+    """
+    def __init__(self, tags=()):
+        self.tags = {} # Name: Tag
+        self.categories = {} # Name: Category
+        self.lock = Lock()
+        for name in tags:
+            self.tag(name)
+
+    def tag(self, name):
+        """Return the Tag called `name`, made if there isn't one yet."""
+        tag = self.tags.get(name)
+        if tag is None:
+            self.lock.acquire()
+            try:
+                if name not in self.tags:
+                    self.tags[name] = Tag(gen_slug(name), name)
+                tag = self.tags[name]
+            finally:
+                self.lock.release()
+        return tag
+
+    def category(self, name):
+        """Return the Category called `name`, made if there isn't one yet."""
+        category = self.categories.get(name)
+        if category is None:
+            self.lock.acquire()
+            try:
+                if name not in self.categories:
+                    self.categories[name] = Category(gen_slug(name), name)
+                category = self.categories[name]
+            finally:
+                self.lock.release()
+        return category
+
+    def taglist(self, value):
+        """
+        Return the tags in an entry's comma separated taglist prop, in
+        order, each once.
+        """
+        result = []
+        seen = set()
+        for name in decode_prop(value).split(u','):
+            name = name.strip()
+            if name and name not in seen:
+                seen.add(name)
+                result.append(self.tag(name))
+        return result
+
+
+class ObjectFile:
+    """
+    Base for files of pickled posts and comments. Authors, tags and
+    categories are stored by name and looked up in `authors` and
+    `registry` when the file is read, so imported objects keep sharing
+    them.
+    """
+    def __init__(self, path, authors, registry):
+        self.path = path
+        self.authors = authors
+        self.registry = registry
+
+    def _pickler(self, f):
+        pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self._persistent_id
+        return pickler
+
+    def _unpickler(self, f):
+        unpickler = pickle.Unpickler(f)
+        unpickler.persistent_load = self._persistent_load
+        return unpickler
+
+    def _persistent_id(self, obj):
+        if isinstance(obj, Author):
+            return ('author', obj.username)
+        elif isinstance(obj, Tag):
+            return ('tag', obj.name)
+        elif isinstance(obj, Category):
+            return ('category', obj.name)
+        return None
+
+    def _persistent_load(self, pid):
+        kind, name = pid
+        if kind == 'author':
+            if name not in self.authors:
+                self.authors[name] = Author(name, '', '')
+            return self.authors[name]
+        elif kind == 'category':
+            return self.registry.category(name)
+        return self.registry.tag(name)
+
+
+class Checkpoint(ObjectFile):
+    """
+    Log of an import's progress, so that an interrupted import can carry
+    on where it stopped. Each step appends a compressed record of what it
+    added: sync times, a batch of posts, a page of comment metadata or
+    bodies. Each record is stored with its length, so that one cut short
+    can be found and cut from the file.
+
+    >>> from tempfile import mkdtemp
+    >>> path = os.path.join(mkdtemp(), 'jace.checkpoint')
+    >>> checkpoint = Checkpoint(path, {}, TagRegistry())
+    >>> checkpoint.start('params')
+    >>> checkpoint.record('meta', 1); checkpoint.record('meta', 2)
+    >>> f = open(path, 'r+b'); f.truncate(os.path.getsize(path) - 5)
+    >>> f.close()
+    >>> list(checkpoint.load('params'))
+    [('meta', 1)]
+    >>> checkpoint.record('meta', 3)
+    >>> list(checkpoint.load('params'))
+    [('meta', 1), ('meta', 3)]
+    >>> checkpoint.load('other params') is None
+    True
+    >>> checkpoint.remove(); os.rmdir(os.path.dirname(path))
+    """
+    def start(self, params):
+        """Start a new log for an import with the given parameters."""
+        folder = os.path.dirname(self.path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        open(self.path, 'wb').close()
+        self.record('params', params)
+
+    def record(self, kind, *data):
+        """Append a record and make sure it is on disk."""
+        buf = StringIO()
+        gz = gzip.GzipFile(fileobj=buf, mode='wb')
+        self._pickler(gz).dump((kind,) + data)
+        gz.close()
+        data = buf.getvalue()
+        f = open(self.path, 'ab')
+        try:
+            f.write(struct.pack('>I', len(data)) + data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+    def load(self, params):
+        """
+        Return an iterator over the records logged after the parameters, or
+        None if there is no log or it was for an import with different
+        parameters. Records are read as the iterator gets to them. A record
+        cut short by the interruption, and anything after it, is dropped
+        from the file once the iterator gets to it, so that records added
+        from then on follow the last good one.
+        """
+        if not os.path.exists(self.path):
+            return None
+        f = open(self.path, 'r+b')
+        if self._read(f) != ('params', params):
+            f.close()
+            return None
+        return self._records(f)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _read(self, f):
+        """Return the next record in `f`, or None if there isn't a whole one."""
+        header = f.read(4)
+        if len(header) < 4:
+            return None
+        size = struct.unpack('>I', header)[0]
+        data = f.read(size)
+        if len(data) < size:
+            return None
+        try:
+            return self._unpickler(gzip.GzipFile(fileobj=StringIO(data),
+                                                 mode='rb')).load()
+        except (EOFError, IOError, ValueError, zlib.error,
+                pickle.UnpicklingError):
+            return None
+
+    def _records(self, f):
+        try:
+            while True:
+                good = f.tell()
+                record = self._read(f)
+                if record is None:
+                    f.seek(good)
+                    f.truncate()
+                    break
+                yield record
+        finally:
+            f.close()
+
+
+class BlogSpool(ObjectFile):
+    """
+    The posts and comments of an import, kept in a file until they go to
+    the import queue, so that a huge journal needn't fit in memory. Both
+    are filed by post id, and comments may be filed before or after their
+    post. Only where each is in the file is kept in memory. The file gets
+    a name of its own in `folder`, so imports running at once don't share
+    it, and is deleted by `remove`.
+    """
+    def __init__(self, folder, authors, registry, prefix=''):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        fd, path = mkstemp(suffix='.spool', prefix=prefix, dir=folder)
+        ObjectFile.__init__(self, path, authors, registry)
+        self.file = os.fdopen(fd, 'w+b')
+        self.index = {} # Post id: [offset of post, offsets of comments]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, postid):
+        return self.index.get(postid, [None])[0] is not None
+
+    def add_post(self, postid, post):
+        entry = self.index.setdefault(postid, [None, []])
+        if entry[0] is None:
+            self.count += 1
+        entry[0] = self._write(post)
+
+    def add_comments(self, postid, comments):
+        """File a list of (id, Comment) under the post with `postid`."""
+        self.index.setdefault(postid, [None, []])[1].append(
+            self._write(comments))
+
+    def postids(self):
+        """Return the ids of the posts, in order."""
+        return sorted([postid for postid, entry in self.index.items()
+                       if entry[0] is not None])
+
+    def orphans(self):
+        """Return the ids of posts that we have comments on but not posts."""
+        return sorted([postid for postid, entry in self.index.items()
+                       if entry[0] is None])
+
+    def post(self, postid):
+        """Return the post with `postid`, without its comments."""
+        return self._read(self.index[postid][0])
+
+    def comments(self, postid):
+        """Return the comments on the post with `postid` as (id, Comment)."""
+        comments = []
+        for offset in self.index[postid][1]:
+            comments.extend(self._read(offset))
+        return comments
+
+    def remove(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _write(self, obj):
+        self.file.seek(0, 2)
+        offset = self.file.tell()
+        self._pickler(self.file).dump(obj)
+        return offset
+
+    def _read(self, offset):
+        self.file.seek(offset)
+        return self._unpickler(self.file).load()
+
+
+class SyncQueue:
+    """
+    The journal entries that syncitems listed, with their sync times. The
+    ones not downloaded yet are kept in a heap by time, so the earliest is
+    always at hand. `latest` is the latest time of any item seen, journal
+    entry or not.
+
+    >>> queue = SyncQueue()
+    >>> queue.add_items([{'item': 'L-2', 'time': '2009-01-02 10:00:00'},
+    ...                  {'item': 'C-9', 'time': '2009-01-03 10:00:00'},
+    ...                  {'item': 'L-1', 'time': '2009-01-01 10:00:00'}])
+    >>> len(queue), queue.latest
+    (2, datetime.datetime(2009, 1, 3, 10, 0))
+    >>> queue.lastsync()
+    '2009-01-01 09:59:59'
+    >>> queue.done(1), queue.done(1)
+    (True, False)
+    >>> queue.lastsync(), queue.synced_until()
+    ('2009-01-02 09:59:59', '2009-01-02 09:59:59')
+    >>> queue.done(2), len(queue), queue.lastsync()
+    (True, 0, None)
+    >>> queue.synced_until()
+    '2009-01-03 10:00:00'
+    """
+    def __init__(self, times=None):
+        self.times = {} # Entry id: sync time
+        self.downloaded = set()
+        self.left = [] # Heap of (sync time, entry id) to download
+        self.latest = None
+        for itemid, synctime in (times or {}).items():
+            self.add(itemid, synctime)
+
+    def __len__(self):
+        return len(self.times) - len(self.downloaded)
+
+    def add_items(self, syncitems):
+        """Add the journal entries from a page of syncitems results."""
+        for item in syncitems:
+            synctime = parse_lj_date(item['time'])
+            if item['item'].startswith('L-'):
+                self.add(int(item['item'][2:]), synctime)
+            elif self.latest is None or synctime > self.latest:
+                self.latest = synctime
+
+    def add(self, itemid, synctime):
+        self.times[itemid] = synctime
+        heappush(self.left, (synctime, itemid))
+        if self.latest is None or synctime > self.latest:
+            self.latest = synctime
+
+    def done(self, itemid):
+        """
+        Mark an entry downloaded. Returns False if it already was, as
+        happens when getevents sends the same entry twice.
+        """
+        if itemid in self.downloaded:
+            return False
+        if itemid not in self.times:
+            raise KeyError(itemid)
+        self.downloaded.add(itemid)
+        return True
+
+    def lastsync(self):
+        """
+        Return the time to ask getevents for entries after, which is a
+        second before the earliest entry left, or None if there are none.
+        """
+        left = self.left
+        while left and (left[0][1] in self.downloaded or
+                        self.times[left[0][1]] != left[0][0]):
+            heappop(left)
+        if not left:
+            return None
+        return (left[0][0] - timedelta(seconds=1)).strftime('%Y-%m-%d %H:%M:%S')
+
+    def synced_until(self):
+        """
+        Return the time up to which every entry has been downloaded, for the
+        next incremental import to go on from: `latest` once none are left,
+        or else the same as `lastsync`. None if nothing was listed.
+        """
+        if len(self):
+            return self.lastsync()
+        if self.latest is None:
+            return None
+        return self.latest.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class CommentInfo:
+    """
+    Metadata for a journal's comments, kept in arrays indexed by comment id
+    rather than in a dict per comment. LiveJournal numbers the comments in
+    a journal from 1 up, so the arrays have few gaps. Posters are kept once
+    each, with their journal URL, and comments refer to them by position.
+
+    >>> c_info = CommentInfo({})
+    >>> c_info.add_users({7: 'jace'})
+    >>> c_info.add(12, 7, COMMENT_MODERATED)
+    >>> c_info.add(10, 0, COMMENT_DELETED)
+    >>> c_info.ids()
+    [10, 12]
+    >>> c_info.poster(12)
+    (None, 'jace', 'http://jace.livejournal.com/')
+    >>> c_info.poster(10)
+    (None, u'', u'')
+    >>> 11 in c_info, c_info.postid(12)
+    (False, None)
+    >>> c_info.set_postid(12, 3)
+    >>> c_info.postid(12), c_info.read
+    (3, 1)
+    >>> c_info.set_time(12, UTC.localize(datetime(2009, 1, 1, 10, 0)))
+    >>> c_info.time(12), c_info.time(10)
+    (datetime.datetime(2009, 1, 1, 10, 0, tzinfo=<UTC>), None)
+    """
+    def __init__(self, authors):
+        self.authors = authors
+        self.users = [(u'', u'')] # (user name, website), anonymous first
+        self.user_index = {0: 0} # LiveJournal user id to position in users
+        self.first_id = 0
+        self.user = array('i') # Position in users of each comment's poster
+        self.state = array('b') # Comment status, or -1 for no comment
+        self.post = array('i') # Post id, or 0 until the body has been read
+        self.times = array('d') # Seconds since the epoch, or 0 for no date
+        self.count = 0
+        self.read = 0 # Comments whose bodies have been read
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, c_id):
+        index = c_id - self.first_id
+        return 0 <= index < len(self.state) and self.state[index] != -1
+
+    def add_users(self, usermap):
+        """Add or rename posters from a {user id: user name} map."""
+        for userid, username in usermap.items():
+            if userid in self.user_index:
+                self.users[self.user_index[userid]] = (username,
+                                                  url_to_journal(username))
+            else:
+                self.user_index[userid] = len(self.users)
+                self.users.append((username, url_to_journal(username)))
+
+    def add(self, c_id, userid, state):
+        """Add a comment by the poster with `userid` and the given status."""
+        if userid not in self.user_index:
+            self.add_users({userid: u''}) # Not in any user map
+        if not len(self.state):
+            self.first_id = c_id
+        elif c_id < self.first_id:
+            gap = self.first_id - c_id
+            self.user = array('i', [0] * gap) + self.user
+            self.state = array('b', [-1] * gap) + self.state
+            self.post = array('i', [0] * gap) + self.post
+            self.times = array('d', [0] * gap) + self.times
+            self.first_id = c_id
+        index = c_id - self.first_id
+        if index >= len(self.state):
+            gap = index + 1 - len(self.state)
+            self.user.extend([0] * gap)
+            self.state.extend([-1] * gap)
+            self.post.extend([0] * gap)
+            self.times.extend([0] * gap)
+        if self.state[index] == -1:
+            self.count += 1
+        self.user[index] = self.user_index[userid]
+        self.state[index] = state
+
+    def ids(self):
+        """Return the ids of all comments, in order."""
+        first_id = self.first_id
+        return [first_id + index for index, state in enumerate(self.state)
+                if state != -1]
+
+    def poster(self, c_id):
+        """Return the Author, user name and website of a comment's poster."""
+        username, website = self.users[self.user[c_id - self.first_id]]
+        return self.authors.get(username), username, website
+
+    def status(self, c_id):
+        return self.state[c_id - self.first_id]
+
+    def postid(self, c_id):
+        """Return the id of the post a comment is on, if it is known yet."""
+        return self.post[c_id - self.first_id] or None
+
+    def set_postid(self, c_id, postid):
+        """Note the post a comment is on, once its body has been read."""
+        index = c_id - self.first_id
+        if not self.post[index]:
+            self.read += 1
+        self.post[index] = postid
+
+    def time(self, c_id):
+        """Return the date a comment was posted, if it is known."""
+        seconds = self.times[c_id - self.first_id]
+        if not seconds:
+            return None
+        return UTC.localize(datetime.utcfromtimestamp(seconds))
+
+    def set_time(self, c_id, pub_date):
+        if pub_date is None:
+            seconds = 0
+        else:
+            seconds = timegm(pub_date.utctimetuple()) + \
+                      pub_date.microsecond / 1000000.0
+        self.times[c_id - self.first_id] = seconds
+
+    def guess_times(self):
+        """
+        Date the comments that were read without a date, as deleted ones
+        are, in one pass. A run of them between two dated comments is
+        spread evenly between their dates, and one before the first or
+        after the last dated comment takes its date. Returns how many
+        comments were dated.
+
+        >>> c_info = CommentInfo({})
+        >>> for c_id, seconds in enumerate([0, 10, 0, 0, 40, 0, 0]):
+        ...     c_info.add(c_id + 1, 0, COMMENT_MODERATED)
+        ...     c_info.set_postid(c_id + 1, 1)
+        ...     c_info.times[c_id] = seconds
+        >>> c_info.guess_times()
+        5
+        >>> list(c_info.times)
+        [10.0, 10.0, 20.0, 30.0, 40.0, 40.0, 40.0]
+        """
+        times = self.times
+        post = self.post
+        run = [] # Positions of undated comments since the last dated one
+        last = 0
+        guessed = 0
+        for index in xrange(len(times)):
+            if not post[index]:
+                continue # No comment, or one we have no body for
+            seconds = times[index]
+            if not seconds:
+                run.append(index)
+                continue
+            if run:
+                if last:
+                    step = (seconds - last) / (len(run) + 1)
+                else:
+                    step = 0
+                    last = seconds
+                for counter, gap in enumerate(run):
+                    times[gap] = last + step * (counter + 1)
+                guessed += len(run)
+                run = []
+            last = seconds
+        if last:
+            for gap in run:
+                times[gap] = last
+            guessed += len(run)
+        return guessed
+
+
 class LiveJournalImportForm(forms.Form):
     """This form asks the user for authorisation and import options."""
     username = forms.TextField(lazy_gettext(u'LiveJournal username'),
@@ -182,6 +1340,15 @@ class LiveJournalImportForm(forms.Form):
                                                   u'assign imported posts to.'),
                                 widget=forms.CheckboxGroup)
     getcomments = forms.BooleanField(lazy_gettext(u'Download Comments?'))
+    incremental = forms.BooleanField(lazy_gettext(u'Only Download Changes?'),
+                                help_text=lazy_gettext(u'Download only the '\
+                                    u'entries changed and comments added '\
+                                    u'since the last import of this journal.'))
+    resume = forms.BooleanField(lazy_gettext(u'Resume Interrupted Import?'),
+                                help_text=lazy_gettext(u'Continue from where '\
+                                    u'the last import of this journal with '\
+                                    u'the same options stopped, instead of '\
+                                    u'downloading everything again.'))
 
     def __init__(self, initial=None):
         initial = forms.fill_dict(initial,
@@ -194,7 +1361,8 @@ class LiveJournalImportForm(forms.Form):
         forms.Form.__init__(self, initial)
 
     def context_validate(self, data):
-        lj = LiveJournalConnect(data['username'], data['password'])
+        lj = LiveJournalConnect(data['username'], data['password'],
+                                url=get_application().cfg[CFG_RPC_URL])
         try:
             result = lj.login()
         except xmlrpclib.Fault, fault:
@@ -219,14 +1387,22 @@ class LiveJournalImporter(Importer):
 
     def import_livejournal(self, username, password, import_what=IMPORT_JOURNAL,
                            community='', security_custom=SECURITY_PROTECTED,
-                           categories=[], getcomments=True):
+                           categories=[], getcomments=True, resume=False,
+                           incremental=False):
         """Import from LiveJournal using specified parameters."""
         yield _(u'<p>Beginning LiveJournal import. Attempting to login...</p>')
         if import_what != IMPORT_JOURNAL:
             usejournal = community
         else:
             usejournal = None
-        lj = LiveJournalConnect(username, password, usejournal)
+        limiter = RateLimiter()
+        lj = LiveJournalConnect(username, password, usejournal, limiter,
+                                self.app.cfg[CFG_RPC_URL])
+        comments_base = self.app.cfg[CFG_COMMENTS_URL]
+        #: Where the time goes, for the table at the end.
+        metrics = ImportMetrics()
+        metrics.watch(lj.stats)
+        metrics.start('login')
         result = lj.login(getmoods=0)
         authors = {username: Author(username=username, email='',
                         real_name=unicode(result['fullname'], 'utf-8'))}
@@ -235,10 +1411,20 @@ class LiveJournalImporter(Importer):
         moodlist = dict([(int(m['id']), unicode(str(m['name']),
                                       'utf-8')) for m in result['moods']])
 
+        #: Get a session key to authenticate the rest of the import with,
+        #: including the HTTP requests to retrieve comments.
+        ljsession = lj.sessiongenerate(expiration='short',
+                                       ipfixed=True)['ljsession']
+        lj.use_session(ljsession)
+
+        metrics.start('tags')
         result = lj.getusertags()
-        tags = dict([(tag, Tag(gen_slug(tag), tag))
-            for tag in [unicode(t['name'], 'utf-8') for t in result['tags']]])
-        yield _(u'<p><strong>Tags:</strong> %s</p>')% _(u', ').join(tags.keys())
+        registry = TagRegistry([decode_prop(t['name']) for t in result['tags']])
+        metrics.add(len(registry.tags))
+        yield _(u'<p><strong>Tags:</strong> %s</p>')% _(u', ').join(
+                                                        registry.tags.keys())
+        #: Every post gets the same Category objects.
+        post_categories = [registry.category(name) for name in categories]
 
         ##result = lj.getdaycounts()
         ##daycounts = [(date(*strptime(item['date'], '%Y-%m-%d')[0:3]),
@@ -251,84 +1437,142 @@ class LiveJournalImporter(Importer):
         ##                                daycounts[0][0].strftime('%Y-%m-%d'),
         ##                                daycounts[-1][0].strftime('%Y-%m-%d'))
 
-        posts = {}
-
-        # Process implemented as per
-        # http://www.livejournal.com/doc/server/ljp.csp.entry_downloading.html
-        yield _(u'<ul>')
-        yield _(u'<li>Getting metadata...</li>')
-        result = lj.syncitems()
-        sync_items = []
-        sync_total = int(result['total'])
-        yield _(u'<li>%d items...</li>') % sync_total
-        sync_items.extend(result['syncitems'])
-        while len(sync_items) < sync_total:
-            lastsync = max([parse_lj_date(item['time']) for item in sync_items]
-                          ).strftime('%Y-%m-%d %H:%M:%S')
-            yield _(u'<li>Got %d items up to %s...</li>') % (len(sync_items), lastsync)
-            result = lj.syncitems(lastsync=lastsync)
-            sync_items.extend(result['syncitems'])
-        yield _(u'<li>Got all %d items.</li>') % len(sync_items)
-        yield _(u'</ul>')
-        #: Discard non-journal items.
-        sync_items = [i for i in sync_items if i['item'].startswith('L-')]
-        yield _(u'<p>Downloading <strong>%d</strong> entries...</p>') % len(sync_items)
-        # Track what items we need to get
-        sync_data = {}
-        for item in sync_items:
-            sync_data[int(item['item'][2:])] = {
-                'downloaded': False,
-                'time': parse_lj_date(item['time'])
-            }
-
-        # Start downloading bodies
-        sync_left = [sync_data[x] for x in sync_data
-                                        if sync_data[x]['downloaded'] is False]
-        if sync_left:
-            lastsync = (min([x['time'] for x in sync_left])-timedelta(seconds=1)
-                                                 ).strftime('%Y-%m-%d %H:%M:%S')
-        while len(sync_left) > 0:
-            yield _(u'<p>Getting a batch...</p>')
-            try:
-                result = lj.getevents(selecttype='syncitems', lastsync=lastsync)
-            except xmlrpclib.Fault, fault:
-                if fault.faultCode == 406:
-                    # LJ doesn't like us. Go back one second and try again.
-                    yield _(u'<p>LiveJournal says we are retrying the same '\
-                            u'date and time too often. Trying again with the '\
-                            u'time set behind by one second.</p>')
-                    lastsync = (parse_lj_date(lastsync) - timedelta(seconds=1)
-                                ).strftime('%Y-%m-%d %H:%M:%S')
-                    continue
+        #: Posts and comments wait on disk until they are all downloaded.
+        #: The spool is rebuilt from the checkpoint on resuming, so it goes
+        #: however the import ends.
+        spool = BlogSpool(os.path.join(self.app.instance_folder, STATE_FOLDER),
+                          authors, registry,
+                          '%s.' % re.sub(r'\W', '_', usejournal or username))
+        try:
+            sync_queue = None
+            c_info = CommentInfo(authors)
+            c_startid = 0
+            c_maxid = None
+            #: Entries with new comments that were fetched on their own
+            orphans_fetched = set()
+
+            def file_comments(page):
+                """File a page of comments in the spool under their posts."""
+                by_post = {}
+                for c_id, (postid, comment) in sorted(page.items()):
+                    by_post.setdefault(postid, []).append((c_id, comment))
+                for postid, post_comments in by_post.items():
+                    spool.add_comments(postid, post_comments)
+
+            #: Where the last import of this journal got to: the time of the
+            #: last entry change and the highest comment id.
+            since = {}
+            if incremental:
+                since = self._load_sync_state(usejournal or username)
+                if since and 'c_maxid' in since:
+                    yield _(u'<p>Downloading entries changed since %s and '\
+                            u'comments after %d.</p>') % (since['lastsync'],
+                                                          since['c_maxid'])
+                    c_startid = since['c_maxid'] + 1
+                elif since:
+                    #: The last import skipped comments, so get them all.
+                    yield _(u'<p>Downloading entries changed since %s and all '\
+                            u'comments.</p>') % since['lastsync']
                 else:
-                    yield _(u'<p>Process failed. LiveJournal says: '\
-                            u'(%d) %s</p>') % (fault.faultCode,
-                                               fault.faultString)
-                    break
+                    yield _(u'<p>This journal has not been imported before. '\
+                            u'Downloading everything.</p>')
 
-            yield _(u'<ol start="%d">') % (len(posts) + 1)
-            for item in result['events']:
-                if sync_data[item['itemid']]['downloaded'] is True:
-                    # Dupe, thanks to our lastsync time manipulation. Skip.
-                    continue
-                sync_data[item['itemid']]['downloaded'] = True
-                sync_data[item['itemid']]['item'] = item
+            checkpoint = Checkpoint(self._state_path(usejournal or username,
+                                                     'checkpoint'),
+                                    authors, registry)
+            params = (import_what, usejournal, security_custom, sorted(categories),
+                      bool(getcomments), sorted(since.items()))
+            records = None
+            if resume:
+                records = checkpoint.load(params)
+                if records is None:
+                    yield _(u'<p>No interrupted import of this journal with '\
+                            u'these options was found. Starting over.</p>')
+            if records is None:
+                checkpoint.start(params)
+            else:
+                metrics.start('resume')
+            for record in records or []:
+                metrics.add()
+                if record[0] == 'sync':
+                    sync_queue = SyncQueue(record[1])
+                elif record[0] == 'events':
+                    for itemid in record[1]:
+                        sync_queue.done(itemid)
+                    for itemid, post in sorted(record[2].items()):
+                        spool.add_post(itemid, post)
+                elif record[0] == 'meta':
+                    c_startid, c_maxid = record[1:3]
+                    c_info.add_users(record[3])
+                    for c_id, c_userid, c_state in record[4]:
+                        c_info.add(c_id, c_userid, c_state)
+                elif record[0] == 'bodies':
+                    for c_id, (postid, comment) in record[1].items():
+                        c_info.set_postid(c_id, postid)
+                        c_info.set_time(c_id, comment.pub_date)
+                    file_comments(record[1])
+                elif record[0] == 'orphan':
+                    orphans_fetched.add(record[1])
+                    if record[2] is not None:
+                        spool.add_post(record[1], record[2])
+
+            if sync_queue is not None:
+                yield _(u'<p>Resuming import with %d posts and %d comments '\
+                        u'already downloaded.</p>') % (len(spool), c_info.read)
+            else:
+                # Process implemented as per
+                # http://www.livejournal.com/doc/server/ljp.csp.entry_downloading.html
+                metrics.start('syncitems')
+                yield _(u'<ul>')
+                yield _(u'<li>Getting metadata...</li>')
+                if since:
+                    result = lj.syncitems(lastsync=since['lastsync'])
+                else:
+                    result = lj.syncitems()
+                #: Track what items we need to get. Non-journal items are
+                #: discarded, but count towards the time to continue from.
+                sync_queue = SyncQueue()
+                sync_count = len(result['syncitems'])
+                sync_total = int(result['total'])
+                metrics.add(sync_count)
+                yield _(u'<li>%d items...</li>') % sync_total
+                sync_queue.add_items(result['syncitems'])
+                while sync_count < sync_total:
+                    lastsync = sync_queue.latest.strftime('%Y-%m-%d %H:%M:%S')
+                    yield _(u'<li>Got %d items up to %s...</li>') % (sync_count, lastsync)
+                    result = lj.syncitems(lastsync=lastsync)
+                    sync_count += len(result['syncitems'])
+                    sync_queue.add_items(result['syncitems'])
+                    metrics.add(len(result['syncitems']))
+                yield _(u'<li>Got all %d items.</li>') % sync_count
+                yield _(u'</ul>')
+                yield _(u'<p>Downloading <strong>%d</strong> entries...</p>') % len(sync_queue)
+                checkpoint.record('sync', sync_queue.times)
+
+            authors_lock = Lock()
 
-                subject = item.get('subject', '')
-                if isinstance(subject, xmlrpclib.Binary):
-                    subject = subject.data
-                subject = unicode(str(subject), 'utf-8')
+            def make_post(item):
+                """
+                Make a Post from a LiveJournal event. Returns the post, or None
+                if it is not to be imported, and a line for the log.
+                """
+                subject = decode_prop(item.get('subject', ''))
                 #: LiveJournal subjects may contain HTML tags. Strip them and
                 #: convert HTML entities to Unicode equivalents.
                 subject = unescape(tag_re.sub('', ljuser_re.sub('\\2', subject)))
                 poster = item.get('poster', username)
                 if poster != username and import_what != IMPORT_COMMUNITY_ALL:
                     # Discard, since we don't want this.
-                    yield _(u'<li><strong>Discarded:</strong> %s <em>(by %s)</em></li>') % (subject,
-                                                                       poster)
-                    continue
-                if poster not in authors:
-                    authors[poster] = Author(poster, '', '')
+                    return None, _(u'<li><strong>Discarded:</strong> %s '\
+                                   u'<em>(by %s)</em></li>') % (subject, poster)
+                #: Posts are made on several threads, which must agree on who's who.
+                authors_lock.acquire()
+                try:
+                    if poster not in authors:
+                        authors[poster] = Author(poster, '', '')
+                    author = authors[poster]
+                finally:
+                    authors_lock.release()
                 # Map LiveJournal security codes to Zine status flags
                 security = item.get('security', 'public')
                 if security == 'usemask' and item['allowmask'] == 1:
@@ -341,9 +1585,8 @@ class LiveJournalImporter(Importer):
                         SECURITY_PRIVATE: STATUS_PRIVATE
                     }[security_custom]
                     if status is None:
-                        yield _(u'<li><strong>Discarded (masked):</strong> '\
-                                u'%s</li>') % subject
-                        continue
+                        return None, _(u'<li><strong>Discarded (masked):</strong> '\
+                                       u'%s</li>') % subject
                 else:
                     status = {
                         'public': STATUS_PUBLISHED,
@@ -355,58 +1598,18 @@ class LiveJournalImporter(Importer):
                 #: doesn't seem to like non-UTC timestamps in imports.
                 pub_date = get_timezone().localize(parse_lj_date(
                     item['eventtime'])).astimezone(UTC)
-                itemtags = [t.strip() for t in unicode(item['props'].get(
-                                            'taglist', ''), 'utf-8').split(',')]
-                while '' in itemtags: itemtags.remove('')
-                itemtags = [tags[t] for t in itemtags]
+                itemtags = registry.taglist(item['props'].get('taglist', ''))
                 extras = {}
-                if 'current_music' in item['props']:
-                    if isinstance(item['props']['current_music'],
-                                  xmlrpclib.Binary):
-                        extras['current_music'] = unicode(item['props']
-                                                ['current_music'].data, 'utf-8')
-                    else:
-                        extras['current_music'] = unicode(str(item['props']
-                                                    ['current_music']), 'utf-8')
-                if 'current_mood' in item['props']:
-                    if isinstance(item['props']['current_mood'],
-                                  xmlrpclib.Binary):
-                        extras['current_mood'] = unicode(item['props']
-                                                ['current_mood'].data, 'utf-8')
-                    else:
-                        extras['current_mood'] = unicode(str(item['props']
-                                                    ['current_mood']), 'utf-8')
-                elif 'current_moodid' in item['props']:
+                for name in TEXT_PROPS:
+                    if name in item['props']:
+                        extras[name] = decode_prop(item['props'][name])
+                if 'current_mood' not in extras and \
+                                        'current_moodid' in item['props']:
                     extras['current_mood'] = moodlist[int(item['props']
                                                             ['current_moodid'])]
-                if 'current_coords' in item['props']:
-                    if isinstance(item['props']['current_coords'],
-                                  xmlrpclib.Binary):
-                        extras['current_coords'] = unicode(item['props']
-                                            ['current_coords'].data, 'utf-8')
-                    else:
-                        extras['current_coords'] = unicode(str(item['props']
-                                                ['current_coords']), 'utf-8')
-                if 'current_location' in item['props']:
-                    if isinstance(item['props']['current_location'],
-                                  xmlrpclib.Binary):
-                        extras['current_location'] = unicode(item['props']
-                                            ['current_location'].data, 'utf-8')
-                    else:
-                        extras['current_location'] = unicode(str(item['props']
-                                                ['current_location']), 'utf-8')
-                if 'picture_keyword' in item['props']:
-                    if isinstance(item['props']['picture_keyword'],
-                                  xmlrpclib.Binary):
-                        extras['picture_keyword'] = unicode(item['props']
-                                            ['picture_keyword'].data, 'utf-8')
-                    else:
-                        extras['picture_keyword'] = unicode(str(item['props']
-                                                ['picture_keyword']), 'utf-8')
-                
                 extras['lj_post_id'] = item['itemid']
                 extras['original_url'] = item['url']
-                posts[item['itemid']] = Post(
+                post = Post(
                     #: Generate slug. If there's no subject, use '-'+itemid.
                     #: Why the prefix? Because if the user wants %year%/%month%/
                     #: for the post url format and we end up creating a slug
@@ -420,13 +1623,13 @@ class LiveJournalImporter(Importer):
                     title=subject,
                     link=item['url'],
                     pub_date=pub_date,
-                    author=authors[poster],
+                    author=author,
                     intro='',
                     body=isinstance(item['event'], xmlrpclib.Binary) and
                             unicode(item['event'].data, 'utf-8') or
                             url_unquote_plus(str(item['event'])),
                     tags=itemtags,
-                    categories=[Category(x) for x in categories],
+                    categories=list(post_categories),
                     comments=[], # Will be updated later.
                     comments_enabled=not item['props'].get(
                                                        'opt_nocomments', False),
@@ -438,190 +1641,368 @@ class LiveJournalImporter(Importer):
                     status=status,
                     extra=extras
                     )
-                yield _(u'<li>%s <em>(by %s on %s)</em></li>') % (subject, poster, pub_date.strftime('%Y-%m-%d %H:%M'))
-            # Done processing batch.
-            yield _(u'</ol>')
-            sync_left = [sync_data[x] for x in sync_data
-                                        if sync_data[x]['downloaded'] is False]
-            if sync_left:
-                lastsync = (min([x['time'] for x in sync_left]) -
-                            timedelta(seconds=1)).strftime('%Y-%m-%d %H:%M:%S')
-
-        # ------------------------------------------------------------------
-        if getcomments:
-            yield _(u"<p>Importing comments...</p>")
-
-            #: Get session key to use for the HTTP request to retrieve comments.
-            ljsession = lj.sessiongenerate(expiration='short',
-                                           ipfixed=True)['ljsession']
-
-            #: See http://www.livejournal.com/bots/ and
-            #: http://www.livejournal.com/doc/server/ljp.csp.auth.cookies.html
-            headers = {
-                'X-LJ-Auth': 'cookie', # Needed only for flat interface, but anyway
-                'Cookie': 'ljsession=%s' % ljsession,
-                'User-Agent': 'LiveJournal-Zine/%s '\
-                              '(http://bitbucket.org/jace/zine-plugins; '\
-                              '<jace at pobox dot com>; en-IN)' % __version__
-                }
-
-            c_usermap = {} # User id to LJ user name
-            c_info = {} # id: {'posterid', 'state'}
+                return post, _(u'<li>%s <em>(by %s on %s)</em></li>') % (subject, poster, pub_date.strftime('%Y-%m-%d %H:%M'))
 
-            c_startid = 0
-            c_maxid = None
+            def finish_batch(batch):
+                """Wait for the posts in a batch, and log and record them."""
+                yield _(u'<ol start="%d">') % (len(spool) + 1)
+                batch_posts = {}
+                for itemid, job in batch:
+                    post, line = builders.result(job)
+                    if post is not None:
+                        batch_posts[itemid] = post
+                        spool.add_post(itemid, post)
+                    yield line
+                # Done processing batch.
+                yield _(u'</ol>')
+                metrics.add(len(batch))
+                checkpoint.record('events', [itemid for itemid, job in batch],
+                                  batch_posts)
+
+            # Start downloading bodies. Each batch is made into posts by the
+            # builders while the next one downloads.
+            metrics.start('getevents')
+            builders = WorkerPool(make_post)
+            batch = None
+            try:
+                lastsync = sync_queue.lastsync()
+                while len(sync_queue) > 0:
+                    yield _(u'<p>Getting a batch...</p>')
+                    try:
+                        result = lj.getevents(selecttype='syncitems',
+                                              lastsync=lastsync)
+                    except xmlrpclib.Fault, fault:
+                        if fault.faultCode in SLOW_DOWN_FAULTS:
+                            # LJ doesn't like us. Go back one second and try
+                            # again, once the limiter has waited a while.
+                            yield _(u'<p>LiveJournal says we are retrying the '\
+                                    u'same date and time too often. Trying again '\
+                                    u'with the time set behind by one second.</p>')
+                            lastsync = (parse_lj_date(lastsync) -
+                                        timedelta(seconds=1)
+                                        ).strftime('%Y-%m-%d %H:%M:%S')
+                            continue
+                        else:
+                            yield _(u'<p>Process failed. LiveJournal says: '\
+                                    u'(%d) %s</p>') % (fault.faultCode,
+                                                       fault.faultString)
+                            break
+
+                    if batch is not None:
+                        for line in finish_batch(batch):
+                            yield line
+                    batch = []
+                    for item in result['events']:
+                        if not sync_queue.done(item['itemid']):
+                            # Dupe, thanks to our lastsync time manipulation. Skip.
+                            continue
+                        batch.append((item['itemid'], builders.submit(item)))
+                    lastsync = sync_queue.lastsync()
+                if batch is not None:
+                    for line in finish_batch(batch):
+                        yield line
+            finally:
+                builders.close()
+            #: If getevents failed, entries are missing. Queueing the rest would
+            #: queue them twice when the import is resumed, and saving where we
+            #: got to would make the next incremental import skip the missing
+            #: ones, so stop here and keep the checkpoint.
+            complete = len(sync_queue) == 0
+
+            # ------------------------------------------------------------------
+            if not complete:
+                yield _(u'<p>Stopped with %d entries not downloaded.</p>') % \
+                                                                len(sync_queue)
+            elif getcomments:
+                yield _(u"<p>Importing comments...</p>")
+
+                #: See http://www.livejournal.com/bots/ and
+                #: http://www.livejournal.com/doc/server/ljp.csp.auth.cookies.html
+                headers = {
+                    'X-LJ-Auth': 'cookie', # Needed only for flat interface, but anyway
+                    'Cookie': 'ljsession=%s' % ljsession,
+                    'User-Agent': 'LiveJournal-Zine/%s '\
+                                  '(http://bitbucket.org/jace/zine-plugins; '\
+                                  '<jace at pobox dot com>; en-IN)' % __version__
+                    }
+
+                fetcher = PageFetcher(headers, limiter=limiter)
+                metrics.watch(fetcher.stats)
+                metrics.start('comment meta')
 
-            while c_maxid is None or c_startid <= c_maxid:
-                #: See http://www.livejournal.com/developer/exporting.bml and
-                #: http://www.livejournal.com/doc/server/ljp.csp.export_comments.html
-                conn = HTTPHandler(urlparse.urlsplit(
-                    LIVEJOURNAL_COMMENTS + '?get=comment_meta&startid=%d%s' %
-                    (c_startid, usejournal and '&authas=%s'%usejournal or '')),
-                    timeout=TIMEOUT, method='GET')
-                conn.headers.extend(headers)
-                yield _(u'<p>Retrieving comment metadata starting from %d...</p>') % c_startid
-                c_metadata = etree.fromstring(conn.open().data)
-
-                if not c_maxid:
-                    if c_metadata.find('maxid') is not None:
-                        c_maxid = int(c_metadata.find('maxid').text)
-
-                for user in c_metadata.find('usermaps'):
-                    c_usermap[int(user.attrib['id'])] = user.attrib['user']
-
-                for comment in c_metadata.find('comments'):
-                    c_id = int(comment.attrib['id'])
-                    c_userid = int(comment.attrib.get('posterid', '0'))
-                    c_username = c_usermap.get(c_userid, u'') # Anonymous == blank
-                    if c_userid != 0:
-                        c_website = url_to_journal(c_username)
-                    else:
-                        c_website = u''
-                    c_info[c_id] = dict(
-                        userid = c_userid,
-                        username = c_username,
-                        author = authors.get(c_username, None),
-                        website = c_website,
-                        state = {'D': COMMENT_DELETED,
+                while c_maxid is None or c_startid <= c_maxid:
+                    yield _(u'<p>Retrieving comment metadata starting from %d...</p>') % c_startid
+                    page_usermap = {}
+                    page_comments = [] # (id, poster id, status)
+                    for element in iter_elements(fetcher.fetch(comments_url(
+                            'comment_meta', c_startid, usejournal, comments_base)),
+                            ('maxid', 'usermap', 'comment')):
+                        if element.tag == 'comment':
+                            page_comments.append((int(element.attrib['id']),
+                                int(element.attrib.get('posterid', '0')),
+                                {'D': COMMENT_DELETED,
                                  'S': COMMENT_BLOCKED_USER,
                                  'F': COMMENT_MODERATED, # No Frozen state in Zine
                                  'A': COMMENT_MODERATED}[
-                                     comment.attrib.get('state', 'A')])
+                                    element.attrib.get('state', 'A')]))
+                        elif element.tag == 'usermap':
+                            page_usermap[int(element.attrib['id'])] = \
+                                                            element.attrib['user']
+                        elif not c_maxid:
+                            c_maxid = int(element.text)
+                    #: User maps may come after the comments, so comments are
+                    #: only matched to their posters once the page is read.
+                    c_info.add_users(page_usermap)
+                    for c_id, c_userid, c_state in page_comments:
+                        c_info.add(c_id, c_userid, c_state)
+                    metrics.add(len(page_comments))
 
-                if not c_maxid:
-                    yield _(u'<p>Something wrong with comment retrieval. '\
-                            u'LiveJournal will not tell us how many there are. '\
-                            u'Aborting.</p>')
-                    break
-                c_startid = max(c_info.keys()) + 1
-
-            yield _(u'<p>Got metadata for %d comments. Retrieving bodies...</p>') % len(c_info)
-
-            c_startid = 0 # Start over again for comment bodies
-            comments = {} # Holds Comment objects.
-            while c_startid <= c_maxid:
-                conn = HTTPHandler(urlparse.urlsplit(
-                    LIVEJOURNAL_COMMENTS + '?get=comment_body&startid=%d%s' %
-                    (c_startid, usejournal and "&authas=%s"%usejournal or '')),
-                    timeout=TIMEOUT, method='GET')
-                conn.headers.extend(headers)
-                yield _(u'<p>Retrieving comment bodies starting from %d...</p>') % c_startid
-                yield _(u'<ol>')
-                c_bodies = etree.fromstring(conn.open().data)
-                for comment in c_bodies.find('comments'):
-                    c_id = int(comment.attrib['id'])
-                    info = c_info[c_id]
-                    bodytag = comment.find('body')
-                    subjecttag = comment.find('subject')
-                    body = bodytag is not None and bodytag.text or u''
-                    if subjecttag is not None:
-                        body = u'<span class="subject">%s</span>\n%s'%(
-                            subjecttag.text, body)
-                    datetag = comment.find('date')
-                    if datetag is None: # Deleted comments have no date
-                        pub_date = None
-                    else:
-                        pub_date = UTC.localize(datetime(*(strptime(
-                                                    comment.find('date').text,
-                                                    '%Y-%m-%dT%H:%M:%SZ')[:6])))
-                    remote_addr = None
-                    if comment.find('property'):
-                        for property in comment.find('property'):
-                            if property.attrib['name'] == 'poster_ip':
-                                remote_addr = property.text
-                    comments[c_id] = Comment(
-                        author=info['author'] or info['username'],
-                        body = body,
-                        author_email = None,
-                        author_url = not info['author']
-                            and info['website'] or None,
-                        parent = 'parentid' in comment.attrib and int(
-                            comment.attrib['parentid']) or None,
-                        pub_date = pub_date,
-                        remote_addr = remote_addr,
-                        parser = u'livejournal',
-                        status = info['state'],
-                    )
-                    postid = int(comment.attrib['jitemid'])
-                    c_info[c_id]['postid'] = postid
-                    if postid in posts:
-                        posts[postid].comments.append(comments[c_id])
-                    else:
-                        # Orphan comment, either because post was dropped or
-                        # because it is not downloaded yet (only when testing)
-                        yield _(u'<li>Dropping orphan comment %d on missing post %d.</li>'
-                                ) % (c_id, postid)
-                c_startid = max(comments.keys()) + 1
-                yield _(u'</ol>')
-            # Calculate timestamps for deleted comments.
-            yield _(u'<p>Guessing timestamps for deleted comments...</p>')
-            sortedcomments = comments.keys()
-            sortedcomments.sort()
-            totalcomments = len(sortedcomments)
-            for counter in range(totalcomments):
-                comment = comments[sortedcomments[counter]]
-                if comment.pub_date is None:
-                    prev_time = comments[sortedcomments[max(0, counter-1)]].pub_date
-                    next_time = comments[sortedcomments[min(totalcomments-1, counter+1)]].pub_date
-                    if prev_time is None and next_time is None:
-                        # No luck with finding time from neighbouring
-                        # comments. Let's look for the post instead.
-                        c_id = sortedcomments[counter]
-                        postid = c_info['c_id']['postid']
-                        if postid in posts:
-                            new_time = posts[postid].pub_date
-                        # else: orphaned comment, anyway. don't bother.
-                    elif next_time is None:
-                        new_time = prev_time
-                    elif prev_time is None:
-                        new_time = next_time
-                    else:
-                        # Midway between previous and next
-                        new_time = prev_time + (next_time - prev_time)/2
-                    # Save new timestamp
-                    comment.pub_date = new_time
-            # Re-thread comments
-            yield _(u'<p>Rethreading comments...</p>')
-            for comment in comments.values():
-                comment.parent = comments.get(comment.parent, None)
-        else:
-            yield _(u'<p>Skipping comment import.</p>')
-        # --------------------------------------------------------------------
+                    if c_maxid is not None and not page_comments:
+                        break # No comments after c_startid
+                    if not c_maxid:
+                        yield _(u'<p>Something wrong with comment retrieval. '\
+                                u'LiveJournal will not tell us how many there are. '\
+                                u'Aborting.</p>')
+                        break
+                    c_startid = max([c[0] for c in page_comments]) + 1
+                    checkpoint.record('meta', c_startid, c_maxid, page_usermap,
+                                      page_comments)
 
+                yield _(u'<p>Got metadata for %d comments. Retrieving bodies...</p>') % len(c_info)
+                metrics.start('comment bodies')
 
-        self.enqueue_dump(Blog(
-            usejournal or username,
-            url_to_journal(username),
-            '',
-            'en',
-            tags.values(),
-            [],
-            posts.values(),
-            authors.values()))
-        flash(_(u'Added imported items to queue.'))
+                #: Metadata gave us every comment id, so we know where each page of
+                #: bodies starts and can download pages ahead of reading them.
+                c_ids = [c_id for c_id in c_info.ids()
+                         if c_info.postid(c_id) is None]
+                c_startids = c_ids[::COMMENT_BODY_PAGE]
+                pages = fetcher.fetch_all([comments_url('comment_body', c_startid,
+                                                        usejournal, comments_base)
+                                           for c_startid in c_startids])
+                for c_startid in c_startids:
+                    yield _(u'<p>Retrieving comment bodies starting from %d...</p>') % c_startid
+                    page = self._read_comment_bodies(pages.next(), c_info)
+                    checkpoint.record('bodies', page)
+                    file_comments(page)
+                    metrics.add(len(page))
+                #: Pick up any comments that pages came back without, one page at
+                #: a time as before.
+                c_missing = [c_id for c_id in c_ids if c_info.postid(c_id) is None]
+                while c_missing:
+                    c_startid = c_missing[0]
+                    yield _(u'<p>Retrieving comment bodies starting from %d...</p>') % c_startid
+                    page = self._read_comment_bodies(fetcher.fetch(comments_url(
+                        'comment_body', c_startid, usejournal, comments_base)),
+                        c_info)
+                    checkpoint.record('bodies', page)
+                    file_comments(page)
+                    metrics.add(len(page))
+                    #: Move past c_startid even if LiveJournal didn't send it.
+                    c_missing = [c_id for c_id in c_missing if c_id > c_startid
+                                 and c_info.postid(c_id) is None]
+                orphans = [postid for postid in spool.orphans()
+                           if postid not in orphans_fetched]
+                if since and orphans:
+                    #: New comments on entries that haven't changed since the
+                    #: last import. Get those entries to put the comments on,
+                    #: and note each in the checkpoint, even if it is not to
+                    #: be imported, so a resumed import doesn't get it again.
+                    metrics.start('orphan entries')
+                    yield _(u'<p>Getting %d entries with new comments...</p>'
+                            ) % len(orphans)
+                    yield _(u'<ol>')
+                    skipped = 0
+                    for postid in orphans:
+                        try:
+                            result = lj.getevents(selecttype='one',
+                                                  itemid=postid)
+                        except xmlrpclib.Fault, fault:
+                            yield _(u'<li><strong>Skipped:</strong> entry %d. '\
+                                    u'LiveJournal says: (%d) %s</li>') % (
+                                postid, fault.faultCode, fault.faultString)
+                            skipped += 1
+                            continue
+                        post = None
+                        for item in result['events']:
+                            post, line = make_post(item)
+                            if post is not None:
+                                spool.add_post(item['itemid'], post)
+                                metrics.add()
+                            yield line
+                        checkpoint.record('orphan', postid, post)
+                    yield _(u'</ol>')
+                    if skipped:
+                        #: Their comments would be lost once the sync state
+                        #: is saved, so stop as when getevents fails.
+                        complete = False
+                        yield _(u'<p>Stopped with %d entries not downloaded.'\
+                                u'</p>') % skipped
+                orphans = spool.orphans()
+                if complete and orphans:
+                    yield _(u'<ul>')
+                    for postid in orphans:
+                        for c_id, comment in spool.comments(postid):
+                            # Orphan comment, either because post was dropped or
+                            # because it is not downloaded yet (only when testing)
+                            yield _(u'<li>Dropping orphan comment %d on missing '\
+                                    u'post %d.</li>') % (c_id, postid)
+                    yield _(u'</ul>')
+                # Calculate timestamps for deleted comments.
+                metrics.start('timestamps')
+                yield _(u'<p>Guessing timestamps for deleted comments...</p>')
+                metrics.add(c_info.guess_times())
+            else:
+                yield _(u'<p>Skipping comment import.</p>')
+            # --------------------------------------------------------------------
 
+
+            metrics.start('enqueue_dump')
+            if not complete:
+                yield _(u'<p>Nothing was queued. Import again with “Resume '\
+                        u'Interrupted Import?” checked to carry on from here.</p>')
+            elif len(spool) or not since:
+                #: Zine takes a whole blog at a time, so a big journal is queued
+                #: in parts, each read back from the spool as it is queued.
+                postids = spool.postids()
+                parts = max(1, (len(postids) + POSTS_PER_DUMP - 1) // POSTS_PER_DUMP)
+                if getcomments:
+                    yield _(u'<p>Rethreading comments...</p>')
+                for part in range(parts):
+                    title = usejournal or username
+                    if parts > 1:
+                        title = u'%s (%d/%d)' % (title, part + 1, parts)
+                        yield _(u'<p>Queueing part %d of %d...</p>') % (part + 1,
+                                                                        parts)
+                    part_ids = postids[part * POSTS_PER_DUMP:
+                                       (part + 1) * POSTS_PER_DUMP]
+                    self.enqueue_dump(Blog(
+                        title,
+                        url_to_journal(username),
+                        '',
+                        'en',
+                        registry.tags.values(),
+                        registry.categories.values(),
+                        [self._spooled_post(spool, c_info, postid)
+                         for postid in part_ids],
+                        authors.values()))
+                    metrics.add(len(part_ids))
+                flash(_(u'Added imported items to queue.'))
+            else:
+                yield _(u'<p>Nothing has changed since the last import.</p>')
+            if complete:
+                if sync_queue.synced_until() is not None:
+                    since['lastsync'] = sync_queue.synced_until()
+                if getcomments and c_maxid is not None:
+                    since['c_maxid'] = max(c_maxid, since.get('c_maxid', 0))
+                #: Without comments there is no c_maxid, and the next import
+                #: gets them all.
+                if 'lastsync' in since:
+                    self._save_sync_state(usejournal or username, since)
+                checkpoint.remove()
+        finally:
+            spool.remove()
+        metrics.finish()
+
+        yield _(u'<p>Made %d requests to LiveJournal, %d of them XML-RPC '\
+                u'calls over %d connections. Retried %d times, and waited '\
+                u'%.1f seconds to keep to its limits.</p>') % (
+                    limiter.stats['requests'], lj.stats['requests'],
+                    lj.stats['connections'], limiter.stats['retries'],
+                    limiter.stats['waited'])
+        for line in metrics.table():
+            yield line
+        metrics_path = self._state_path(usejournal or username,
+                                        'metrics.json')
+        metrics.save(metrics_path)
+        yield _(u'<p>These figures were saved to %s.</p>') % metrics_path
         yield _(u'<p><strong>All done.</strong></p>')
 
+    def _state_path(self, journal, kind):
+        return os.path.join(self.app.instance_folder, STATE_FOLDER,
+                            '%s.%s' % (re.sub(r'\W', '_', journal), kind))
+
+    def _load_sync_state(self, journal):
+        """Return where the last import of `journal` got to, if anywhere."""
+        path = self._state_path(journal, 'sync')
+        if not os.path.exists(path):
+            return {}
+        f = open(path, 'rb')
+        try:
+            return pickle.load(f)
+        finally:
+            f.close()
+
+    def _save_sync_state(self, journal, since):
+        path = self._state_path(journal, 'sync')
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'wb')
+        try:
+            pickle.dump(since, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+    def _spooled_post(self, spool, c_info, postid):
+        """
+        Read a post back from the spool with its comments, dated where they
+        had no date and threaded. Comments are only undated here if none in
+        the journal had a date, so they get the post's.
+        """
+        post = spool.post(postid)
+        post_comments = spool.comments(postid)
+        by_id = dict(post_comments)
+        for c_id, comment in post_comments:
+            if comment.pub_date is None:
+                comment.pub_date = c_info.time(c_id) or post.pub_date
+            comment.parent = by_id.get(comment.parent, None)
+        post.comments = [comment for c_id, comment in post_comments]
+        return post
+
+    def _read_comment_bodies(self, data, c_info):
+        """
+        Make Comment objects from a page of comment bodies, noting their
+        posts and dates in `c_info`. Returns the new comments as
+        {id: (post id, Comment)}.
+        """
+        page = {}
+        for comment in iter_elements(data, ('comment',)):
+            c_id = int(comment.attrib['id'])
+            if c_info.postid(c_id) is not None:
+                continue # Already read from an earlier page
+            author, username, website = c_info.poster(c_id)
+            bodytag = comment.find('body')
+            subjecttag = comment.find('subject')
+            body = bodytag is not None and bodytag.text or u''
+            if subjecttag is not None:
+                body = u'<span class="subject">%s</span>\n%s'%(
+                    subjecttag.text, body)
+            datetag = comment.find('date')
+            if datetag is None: # Deleted comments have no date
+                pub_date = None
+            else:
+                pub_date = UTC.localize(datetime(*(strptime(
+                                            comment.find('date').text,
+                                            '%Y-%m-%dT%H:%M:%SZ')[:6])))
+            remote_addr = None
+            for property in comment.findall('property'):
+                if property.attrib['name'] == 'poster_ip':
+                    remote_addr = property.text
+            page[c_id] = (int(comment.attrib['jitemid']), Comment(
+                author=author or username,
+                body = body,
+                author_email = None,
+                author_url = not author and website or None,
+                parent = 'parentid' in comment.attrib and int(
+                    comment.attrib['parentid']) or None,
+                pub_date = pub_date,
+                remote_addr = remote_addr,
+                parser = u'livejournal',
+                status = c_info.status(c_id),
+            ))
+            c_info.set_postid(c_id, page[c_id][0])
+            c_info.set_time(c_id, pub_date)
+        return page
+
     def configure(self, request):
         form = LiveJournalImportForm()
 
@@ -635,7 +2016,9 @@ class LiveJournalImporter(Importer):
                       community = form.data['community'],
                       security_custom = form.data['security_custom'],
                       categories = form.data['categories'],
-                      getcomments = form.data['getcomments']),
+                      getcomments = form.data['getcomments'],
+                      resume = form.data['resume'],
+                      incremental = form.data['incremental']),
                 _stream=True)
 
         return self.render_admin_page('admin/import_livejournal.html',
@@ -643,6 +2026,9 @@ class LiveJournalImporter(Importer):
 
 
 def setup(app, plugin):
+    app.add_config_var(CFG_RPC_URL, forms.TextField(default=LIVEJOURNAL_RPC))
+    app.add_config_var(CFG_COMMENTS_URL,
+                       forms.TextField(default=LIVEJOURNAL_COMMENTS))
     app.add_importer(LiveJournalImporter)
     app.add_template_searchpath(TEMPLATES)
 
@@ -1,11 +1,26 @@
 import os.path
 import re
+from tempfile import mkstemp
+from threading import Lock
+try: from hashlib import sha1
+except ImportError: from sha import new as sha1
 from zine.api import *
 from zine.utils import log
 from zine.parsers import BaseParser
-from zine.utils.zeml import sanitize, parse_zeml, Element
+from zine.utils import forms
+from zine.utils.zeml import sanitize, parse_zeml, Element, \
+     dump_parser_data, load_parser_data
 
 SHARED_FILES = os.path.join(os.path.dirname(__file__), 'shared')
+CFG_RENDER_CACHE = 'livejournal_parser/render_cache'
+#: Values that option may take
+RENDER_CACHES = ('memory', 'disk', 'none')
+
+#: Folder in the instance folder for the disk render cache
+CACHE_FOLDER = 'livejournal_cache'
+
+#: Bump whenever parser output changes, so cached renders are not reused.
+PARSER_VERSION = '0.3'
 
 #: List from http://www.livejournal.com/support/faqbrowse.bml?faqid=72
 tags = ('a', 'b', 'big', 'blockquote', 'br', 'center', 'cite', 'code',
@@ -21,10 +36,18 @@ allowed_tags = {
                                                     'form', 'input', 'select')])
     }
 
+
+def allowed_tags_for(reason):
+    """Return the set of tags allowed for the given parse reason."""
+    return allowed_tags.get(reason in allowed_tags and reason or 'post')
+
 ljuser_re = re.compile(r'''<lj\s+(user|comm)\s*=\s*"?'?(\w+)"?'?\s*>''', re.U | re.I)
 tag_re = re.compile(r'</?(\w+).*?/?>', re.IGNORECASE | re.UNICODE)
 ljcut_re = re.compile(r'</?lj-cut.*?>', re.IGNORECASE | re.UNICODE)
-url_re = re.compile(r'''(^|>)([^<]*)(https?|ftp|irc|mailto):(.*?)(:?;?,?\.?[\s\'\"\(\)\[\]\{\}<>])''', re.U)
+url_re = re.compile(r'''(^|>)([^<]*)(https?|ftp|irc|mailto):(.*?)(:?;?,?\.?(?:[\s\'\"\(\)\[\]\{\}<>]|$))''', re.U)
+#: url_re in two parts, for linkify
+urlscheme_re = re.compile(r'(https?|ftp|irc|mailto):', re.U)
+urltail_re = re.compile(r'''(.*?)(:?;?,?\.?(?:[\s\'\"\(\)\[\]\{\}<>]|$))''', re.U)
 
 #: http://www.livejournal.com/support/faqbrowse.bml?faqid=26
 ljrawtag_re = re.compile(r'<lj-raw>', re.IGNORECASE | re.UNICODE)
@@ -33,6 +56,39 @@ ljraw1_re = re.compile(r'(^|</lj-raw>)(.*?)(<lj-raw>)',
 ljraw2_re = re.compile(r'(</lj-raw>)(.*?)(<lj-raw>|$)',
                        re.IGNORECASE | re.UNICODE | re.DOTALL)
 
+#: Markup picked out by the single-pass tokenizer, outside and inside lj-raw
+#: sections. Outside lj-raw, newlines become <br> tags, so a newline ends any
+#: tag it turns up in and can't be part of an <lj user> tag. Every token ends
+#: at the first '>' after its '<', and all but an <lj user> tag inside lj-raw
+#: (rawuser_re) at or before the first newline, so _find_token matches them
+#: only against the text up to there.
+token_re = re.compile(r"""
+    (?P<cut></?lj-cut.*?>) |
+    (?P<raw><lj-raw>) |
+    (?P<user><lj[^\S\n]+(?P<ljtype>user|comm)[^\S\n]*=[^\S\n]*"?'?(?P<userid>\w+)"?'?[^\S\n]*>) |
+    (?P<tag></?(?P<name>\w+)[^\n>]*(?:>|\n))
+    """, re.IGNORECASE | re.UNICODE | re.VERBOSE)
+rawtoken_re = re.compile(r"""
+    (?P<cut></?lj-cut.*?>) |
+    (?P<endraw></lj-raw>) |
+    (?P<user><lj\s+(?P<ljtype>user|comm)\s*=\s*"?'?(?P<userid>\w+)"?'?\s*>) |
+    (?P<tag></?(?P<name>\w+)[^\n>]*>)
+    """, re.IGNORECASE | re.UNICODE | re.VERBOSE)
+rawuser_re = re.compile(r"""
+    (?P<user><lj\s+(?P<ljtype>user|comm)\s*=\s*"?'?(?P<userid>\w+)"?'?\s*>)
+    """, re.IGNORECASE | re.UNICODE | re.VERBOSE)
+#: Where a token may start. Every one has a '/' or a letter after its '<'.
+tokenstart_re = re.compile(r'<[/\w]', re.UNICODE)
+
+#: Longest token the single-pass tokenizer picks out, from its '<' to its
+#: end. A '<' with no end that near is text, so a stream of markup is never
+#: held back further than this waiting for a tag to end.
+MAX_TAG_LENGTH = 8192
+
+#: Use the single-pass tokenizer in htmlize_markup. Set to False to fall back
+#: to the older series of regular expression substitutions.
+SINGLE_PASS = True
+
 def split_intro(text, reason='entry'):
     """
     Split text at first lj-cut tag.
@@ -60,9 +116,399 @@ def split_intro(text, reason='entry'):
         return tuple([ljcut_re.sub(u'', t) for t in ljcut_re.split(text, maxsplit=1)])
 
 
-def htmlize_markup(input_data, reason):
+def hit_stats(hits, misses):
+    """Dictionary of hits, misses and hit rate, for reporting cache use."""
+    total = hits + misses
+    return dict(hits=hits, misses=misses,
+                hit_rate=total and float(hits) / total or 0.0)
+
+
+class Memo(object):
+    """
+    Remembers up to `size` results of `func`, a function of hashable
+    arguments, and counts hits and misses. Forgets everything when full.
+
+    >>> double = Memo(lambda x: x * 2, size=2)
+    >>> double(1), double(1), double(2)
+    (2, 2, 4)
+    >>> double.stats['hits'], double.stats['misses']
+    (1, 2)
+    """
+
+    def __init__(self, func, size=1000):
+        self.func = func
+        self.size = size
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+        self.__doc__ = func.__doc__
+
+    def __call__(self, *args):
+        try:
+            result = self.results[args]
+        except KeyError:
+            self.misses += 1
+            if len(self.results) >= self.size:
+                self.results.clear()
+            result = self.results[args] = self.func(*args)
+        else:
+            self.hits += 1
+        return result
+
+    @property
+    def stats(self):
+        """Dictionary of hits, misses and hit rate."""
+        return hit_stats(self.hits, self.misses)
+
+
+def _journal_url(ljtype, userid):
+    """
+    Return the URL to a LiveJournal user's or community's journal.
+
+    >>> journal_url('user', 'hi_there')
+    'http://hi-there.livejournal.com/'
+    >>> journal_url('comm', 'bangalore')
+    'http://community.livejournal.com/bangalore/'
+    """
+    if ljtype == 'comm':
+        return 'http://community.livejournal.com/%s/' % userid
+    elif userid.startswith('_') or userid.endswith('_'):
+        return 'http://users.livejournal.com/%s/' % userid
+    else:
+        return 'http://%s.livejournal.com/' % userid.replace('_', '-')
+
+#: Memoized _journal_url, also used by the LiveJournal importer.
+journal_url = Memo(_journal_url, 5000)
+
+
+def _userlink(ljtype, userid):
+    """
+    Render the HTML for an <lj user> or <lj comm> tag.
+
+    >>> userlink('comm', 'bangalore')
+    u'<span class="livejournal"><a href="http://community.livejournal.com/bangalore/profile"><img width="16" alt="[info]" src="http://l-stat.livejournal.com/img/community.gif" height="16"></a><a href="http://community.livejournal.com/bangalore/">bangalore</a></span>'
+    """
+    url = journal_url(ljtype, userid)
+    profileurl = url + 'profile'
+    if ljtype == 'user':
+        return u'<span class="livejournal"><a href="%s"><img '\
+               u'width="17" alt="[info]" '\
+               u'src="http://l-stat.livejournal.com/img/userinfo.gif" '\
+               u'height="17"></a><a '\
+               u'href="%s">%s</a></span>' % (profileurl, url, userid)
+    else:
+        return u'<span class="livejournal"><a href="%s"><img '\
+              u'width="16" alt="[info]" '\
+              u'src="http://l-stat.livejournal.com/img/community.gif" '\
+              u'height="16"></a><a '\
+              u'href="%s">%s</a></span>' % (profileurl, url, userid)
+
+#: Memoized _userlink. Comment threads name the same few users over and over.
+userlink = Memo(_userlink, 2000)
+
+
+def _makeuserlink(matchobj):
+    return userlink(matchobj.group(1), matchobj.group(2))
+
+
+def _makelinks(matchobj):
+    return '%s%s<a href="%s:%s">%s:%s</a>%s' % (matchobj.group(1),
+                                            matchobj.group(2),
+                                            matchobj.group(3),
+                                            matchobj.group(4),
+                                            matchobj.group(3),
+                                            matchobj.group(4),
+                                            matchobj.group(5))
+
+
+def linkify(text):
+    """
+    Turn URLs in text into links, in time linear to the length of the text.
+    Gives the same result as ``url_re.sub(_makelinks, text)``: in each run of
+    text that starts the text or follows a '>' and ends at the next '<', the
+    last URL is linked. url_re backtracks through the rest of the run from
+    every '>' in it, which takes quadratic time on long runs without tags.
+
+    >>> linkify(u'See http://example.com/, or <b>ftp://example.com</b>.')
+    u'See <a href="http://example.com/">http://example.com/</a>, or <b><a href="ftp://example.com">ftp://example.com</a></b>.'
+    >>> linkify(u'Only the last in a run: http://a.com/ http://b.com/ <b>')
+    u'Only the last in a run: http://a.com/ <a href="http://b.com/">http://b.com/</a> <b>'
+    """
+    if u':' not in text:
+        return text # No URL without a scheme
+    result = []
+    pos = 0 # Text up to here is in result
+    start = 0 # Start of the next run to look at
+    length = len(text)
+    while True:
+        end = text.find('<', start)
+        if end == -1:
+            end = length
+        scheme = None
+        for scheme in urlscheme_re.finditer(text, start, end):
+            pass
+        if scheme is not None:
+            tail = urltail_re.match(text, scheme.end())
+            result.append(text[pos:scheme.start()])
+            result.append('<a href="%s:%s">%s:%s</a>%s' % (scheme.group(1),
+                          tail.group(1), scheme.group(1), tail.group(1),
+                          tail.group(2)))
+            pos = tail.end()
+        # Runs starting at a later '>' before `end` are part of this one and
+        # hold no other URL that could be linked, so skip past them.
+        start = text.find('>', max(pos, end))
+        if start == -1:
+            break
+        start += 1
+    result.append(text[pos:])
+    return u''.join(result)
+
+
+def _htmlize_regex(input_data, reason):
+    """
+    Convert LiveJournal markup to HTML with a series of regular expression
+    substitutions over the whole text. Returns tuple of intro and body.
+    """
+    allowed = allowed_tags_for(reason)
+
+    def _checktag(matchobj):
+        tag = matchobj.group(1)
+        if tag in allowed:
+            return matchobj.group(0)
+        else:
+            return u''
+
+
+    def _convertnewlines(matchobj):
+        return url_re.sub(_makelinks, matchobj.group(1) +
+                          matchobj.group(2).replace('\r\n', '\n').replace(
+                              '\n', '<br>') + matchobj.group(3))
+
+    intro, body = split_intro(input_data, reason)
+    if ljrawtag_re.search(intro):
+        intro = ljraw2_re.sub(_convertnewlines,
+                              ljraw1_re.sub(_convertnewlines, intro))
+    else:
+        intro = re.sub(r'(?s)()(.*)()', _convertnewlines, intro)
+    if ljrawtag_re.search(body):
+        body = ljraw2_re.sub(_convertnewlines,
+                            ljraw1_re.sub(_convertnewlines, body))
+    else:
+        body = re.sub(r'(?s)()(.*)()', _convertnewlines, body)
+
+    intro = tag_re.sub(_checktag,
+        ljuser_re.sub(_makeuserlink, intro))
+    body = tag_re.sub(_checktag,
+        ljuser_re.sub(_makeuserlink, body))
+    return (intro, body)
+
+
+def _find_token(buf, pos, raw, ends):
+    """
+    Return the first token in `buf` from `pos`, or None. Each '<' that may
+    start one is matched only against the text up to the next '>' or
+    newline after it, where any token starting there must end. Those are
+    found with `ends`, a dictionary of the last ones found, so each is
+    looked for once however many '<' come before it, and a '<' that starts
+    no token costs little. A '<' with no end within MAX_TAG_LENGTH
+    characters is text. `ends` must be emptied when `buf` changes.
+
+    >>> _find_token(u'a < b <i>c</i>', 0, False, {}).group(0)
+    u'<i>'
+    >>> _find_token(u'a<b ' * 3, 0, False, {}) is None
+    True
+    >>> _find_token(u'<a title="%s">' % (u'x' * MAX_TAG_LENGTH), 0, False, {}) is None
+    True
+    """
+    regex = raw and rawtoken_re or token_re
+    while True:
+        start = tokenstart_re.search(buf, pos)
+        if start is None:
+            return None
+        lt = start.start()
+        gt = ends.get(u'>')
+        if gt is None or -1 < gt < lt:
+            gt = ends[u'>'] = buf.find(u'>', lt)
+        nl = ends.get(u'\n')
+        if nl is None or -1 < nl < lt:
+            nl = ends[u'\n'] = buf.find(u'\n', lt)
+        if raw or nl == -1 or -1 < gt < nl:
+            end = gt
+        else:
+            end = nl
+        if end == -1:
+            # Nothing after this '<' can end a token.
+            return None
+        if raw and -1 < nl < gt:
+            # Only an <lj user> tag goes on past a newline.
+            matchobj = None
+            if buf[lt:lt + 3].lower() == u'<lj' and \
+                    gt - lt < MAX_TAG_LENGTH:
+                matchobj = rawuser_re.match(buf, lt, gt + 1)
+        elif end - lt >= MAX_TAG_LENGTH:
+            matchobj = None
+        else:
+            matchobj = regex.match(buf, lt, end + 1)
+        if matchobj is not None:
+            return matchobj
+        pos = lt + 1
+
+
+def iter_htmlize_markup(chunks, reason, allowed=None):
+    """
+    Convert LiveJournal markup to HTML as it arrives in `chunks`, an iterable
+    of unicode strings, yielding ``(part, html)`` tuples as it goes. Part 0
+    is the intro if an lj-cut turns up later, or else the body. Part 1 is
+    the body after the cut; the cut itself yields ``(1, u'')``.
+
+    Only a possibly incomplete tag at the end of a chunk, of no more than
+    MAX_TAG_LENGTH characters, and the text of the line since the last tag
+    are held back, so the whole input is never in memory at once.
+
+    >>> list(iter_htmlize_markup([u'Hi\\nthe', u're <lj-', u'cut>world'], 'entry'))
+    [(0, u'Hi<br>'), (0, u'there '), (1, u''), (1, u'world')]
+    """
+    if allowed is None:
+        allowed = allowed_tags_for(reason)
+    chunks = iter(chunks)
+    more = True # There may be more chunks
+    buf = u''
+    pending = [] # Text since the last tag, joined across dropped cuts
+    part = 0
+    splitting = reason != 'comment'
+    raw = False
+    pos = 0
+    ends = {}
+    while True:
+        matchobj = _find_token(buf, pos, raw, ends)
+        if matchobj is None and more:
+            # Hold back anything after the last place a tag can end, since
+            # the next chunk may complete a tag in it, and read on. A '<'
+            # further back than MAX_TAG_LENGTH can't start a tag any more.
+            if raw:
+                end = buf.rfind(u'>')
+            else:
+                end = max(buf.rfind(u'>'), buf.rfind(u'\n'))
+            keep = buf.find(u'<', max(pos, end + 1,
+                                      len(buf) - MAX_TAG_LENGTH + 1))
+            if keep == -1:
+                keep = len(buf)
+            text = buf[pos:keep]
+            if raw:
+                split = len(text)
+            else:
+                # A line break starts a new run for linkify, so whole lines
+                # can be converted now.
+                split = text.rfind(u'\n') + 1
+            if split:
+                pending.append(text[:split])
+                yield part, _convert_text(u''.join(pending), raw)
+                del pending[:]
+            if split < len(text):
+                pending.append(text[split:])
+            try:
+                buf = buf[keep:] + chunks.next()
+            except StopIteration:
+                buf = buf[keep:]
+                more = False
+            pos = 0
+            ends.clear()
+            continue
+        if matchobj is None:
+            text = buf[pos:]
+        else:
+            text = buf[pos:matchobj.start()]
+            kind = matchobj.lastgroup
+            if kind == 'cut' and not splitting:
+                # Drop the cut, but keep the text on either side together.
+                pending.append(text)
+                pos = matchobj.end()
+                continue
+        if pending:
+            pending.append(text)
+            text = u''.join(pending)
+            del pending[:]
+        if text:
+            yield part, _convert_text(text, raw)
+        if matchobj is None:
+            break
+        if kind == 'tag':
+            if matchobj.group('name') in allowed:
+                html = matchobj.group(0)
+                if u'\n' in html:
+                    html = html.replace(u'\r\n', u'\n').replace(u'\n', u'<br>')
+                yield part, html
+        elif kind == 'cut':
+            part = 1
+            splitting = False
+            raw = False
+            yield part, u''
+        elif kind == 'raw':
+            raw = True
+        elif kind == 'endraw':
+            raw = False
+        elif kind == 'user':
+            yield part, userlink(matchobj.group('ljtype'),
+                                 matchobj.group('userid'))
+        pos = matchobj.end()
+
+
+def _convert_text(text, raw):
+    """Convert newlines and link URLs in text outside lj-raw sections."""
+    if raw:
+        return text
+    return linkify(text.replace(u'\r\n', u'\n').replace(u'\n', u'<br>'))
+
+
+def _join_parts(fragments):
+    """Join ``(part, html)`` tuples into a tuple of intro and body."""
+    parts = ([], [])
+    for part, html in fragments:
+        parts[part].append(html)
+    if not parts[1]:
+        return (u'', u''.join(parts[0]))
+    return (u''.join(parts[0]), u''.join(parts[1]))
+
+
+def _htmlize_single_pass(input_data, reason, allowed=None):
+    """
+    Convert LiveJournal markup to HTML in one walk over the text, splitting
+    off the intro when the first lj-cut tag goes by. Returns tuple of intro
+    and body.
+
+    Unlike :func:`_htmlize_regex`, text between two lj-raw sections is
+    converted only once, so URLs in it are not linked twice over.
+
+    >>> _htmlize_single_pass(u'<lj-raw>a</lj-raw> http://example.com/ <lj-raw>b</lj-raw>', 'comment')
+    (u'', u'a <a href="http://example.com/">http://example.com/</a> b')
+
+    A newline ending the text after an lj-raw section is converted too,
+    where :func:`_htmlize_regex` leaves it be:
+
+    >>> _htmlize_single_pass(u'<lj-raw>a</lj-raw>b\\n', 'comment')
+    (u'', u'ab<br>')
+
+    A tag is read from its '<' to the first '>', so a '<' inside an
+    unclosed tag is part of that tag and no lj-cut starts there. The
+    regex path takes the lj-cut out first and leaves ``(u'<i', u'more')``:
+
+    >>> _htmlize_single_pass(u'<i<lj-cut>more', 'entry')
+    (u'', u'<i<lj-cut>more')
+
+    Text on either side of a dropped tag is not read again as one, so no
+    new tag is made out of the pieces, where the regex path keeps
+    ``u'<a</lj-raw>'`` here:
+
+    >>> _htmlize_single_pass(u'<</lj-cut>a</lj-raw>', 'comment')
+    (u'', u'<a')
+    """
+    return _join_parts(iter_htmlize_markup([input_data], reason, allowed))
+
+
+def htmlize_markup(input_data, reason, allowed=None):
     """
     Convert LiveJournal markup to HTML. Returns tuple of intro and body.
+    `allowed` is the set of allowed tags, if already looked up for `reason`.
 
     >>> htmlize_markup(u'This is some\\ntext here.', 'comment')
     (u'', u'This is some<br>text here.')
@@ -115,71 +561,243 @@ def htmlize_markup(input_data, reason):
     >>> htmlize_markup(u'<lj-raw>skip me</lj-raw> http://example.com/', 'entry')
     (u'', u'skip me <a href="http://example.com/">http://example.com/</a>')
     """
-    def _makeuserlink(matchobj):
-        ljtype = matchobj.group(1)
-        userid = matchobj.group(2)
-        if ljtype == 'comm':
-            url = 'http://community.livejournal.com/%s/' % userid
-        elif userid.startswith('_') or userid.endswith('_'):
-            url = 'http://users.livejournal.com/%s/' % userid
-        else:
-            url = 'http://%s.livejournal.com/' % userid.replace('_', '-')
-        profileurl = url + 'profile'
-        if ljtype == 'user':
-            return u'<span class="livejournal"><a href="%s"><img '\
-                   u'width="17" alt="[info]" '\
-                   u'src="http://l-stat.livejournal.com/img/userinfo.gif" '\
-                   u'height="17"></a><a '\
-                   u'href="%s">%s</a></span>' % (profileurl, url, userid)
-        else:
-            return u'<span class="livejournal"><a href="%s"><img '\
-                  u'width="16" alt="[info]" '\
-                  u'src="http://l-stat.livejournal.com/img/community.gif" '\
-                  u'height="16"></a><a '\
-                  u'href="%s">%s</a></span>' % (profileurl, url, userid)
+    if SINGLE_PASS:
+        return _htmlize_single_pass(input_data, reason, allowed)
+    return _htmlize_regex(input_data, reason)
 
 
-    def _checktag(matchobj):
-        tag = matchobj.group(1)
-        if tag in allowed_tags.get(reason in allowed_tags and reason
-                                                                or 'post'):
-            return matchobj.group(0)
+class RenderCache(object):
+    """
+    Base class for caches of parsed LiveJournal markup. Entries are keyed on
+    a hash of the input, the parse reason and the parser version, and hold
+    the serialized ZEML tree. Subclasses implement `_get`, `_set` and
+    `clear`.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, input_data, reason):
+        """Return the cache key for `input_data` parsed for `reason`."""
+        if isinstance(input_data, unicode):
+            input_data = input_data.encode('utf-8')
+        return sha1('%s\0%s\0%s\0%s' % (PARSER_VERSION, SINGLE_PASS and 1 or 0,
+                                       reason, input_data)).hexdigest()
+
+    def get(self, key):
+        """Return the cached data for `key`, or None."""
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
         else:
-            return u''
+            self.hits += 1
+        return value
 
+    def set(self, key, value):
+        """Store `value` under `key`."""
+        self._set(key, value)
 
-    def _makelinks(matchobj):
-        return '%s%s<a href="%s:%s">%s:%s</a>%s' % (matchobj.group(1),
-                                                matchobj.group(2),
-                                                matchobj.group(3),
-                                                matchobj.group(4),
-                                                matchobj.group(3),
-                                                matchobj.group(4),
-                                                matchobj.group(5))
+    @property
+    def stats(self):
+        """Dictionary of hits, misses and hit rate."""
+        return hit_stats(self.hits, self.misses)
 
+    def _get(self, key):
+        raise NotImplementedError()
 
-    def _convertnewlines(matchobj):
-        return url_re.sub(_makelinks, matchobj.group(1) +
-                          matchobj.group(2).replace('\r\n', '\n').replace(
-                              '\n', '<br>') + matchobj.group(3))
+    def _set(self, key, value):
+        raise NotImplementedError()
 
-    intro, body = split_intro(input_data, reason)
-    if ljrawtag_re.search(intro):
-        intro = ljraw2_re.sub(_convertnewlines,
-                              ljraw1_re.sub(_convertnewlines, intro))
-    else:
-        intro = re.sub(r'(?s)()(.*)()', _convertnewlines, intro)
-    if ljrawtag_re.search(body):
-        body = ljraw2_re.sub(_convertnewlines,
-                            ljraw1_re.sub(_convertnewlines, body))
-    else:
-        body = re.sub(r'(?s)()(.*)()', _convertnewlines, body)
+    def clear(self):
+        raise NotImplementedError()
 
-    intro = tag_re.sub(_checktag,
-        ljuser_re.sub(_makeuserlink, intro))
-    body = tag_re.sub(_checktag,
-        ljuser_re.sub(_makeuserlink, body))
-    return (intro, body)
+
+class NullRenderCache(RenderCache):
+    """A render cache that stores nothing."""
+
+    def _get(self, key):
+        return None
+
+    def _set(self, key, value):
+        pass
+
+    def clear(self):
+        pass
+
+
+class MemoryRenderCache(RenderCache):
+    """
+    In-process render cache holding up to `max_entries` items. When full,
+    the least recently used quarter of the entries is dropped.
+
+    >>> cache = MemoryRenderCache(max_entries=4)
+    >>> for key in 'abcd':
+    ...     cache.set(key, key.upper())
+    >>> cache.get('a')
+    'A'
+    >>> cache.set('e', 'E')
+    >>> cache.get('b') is None
+    True
+    >>> cache.get('a')
+    'A'
+    >>> cache.stats['hits'], cache.stats['misses']
+    (2, 1)
+    """
+
+    def __init__(self, max_entries=500):
+        RenderCache.__init__(self)
+        self.max_entries = max_entries
+        self._entries = {} # key: [last use, value]
+        self._tick = 0
+        self._lock = Lock()
+
+    def _get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._tick += 1
+            entry[0] = self._tick
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def _set(self, key, value):
+        self._lock.acquire()
+        try:
+            if key not in self._entries and \
+                                    len(self._entries) >= self.max_entries:
+                self._prune()
+            self._tick += 1
+            self._entries[key] = [self._tick, value]
+        finally:
+            self._lock.release()
+
+    def _prune(self):
+        entries = sorted(self._entries.items(), key=lambda item: item[1][0])
+        for key, entry in entries[:max(1, len(entries) // 4)]:
+            del self._entries[key]
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+
+class FileSystemRenderCache(RenderCache):
+    """
+    On-disk render cache, one file per entry in `path`. A file's
+    modification time records its last use, and the least recently used
+    quarter of the files is removed when there are more than `max_entries`.
+    """
+
+    def __init__(self, path, max_entries=5000):
+        RenderCache.__init__(self)
+        self.path = path
+        self.max_entries = max_entries
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._count = len(self._list_files())
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.zeml')
+
+    def _list_files(self):
+        return [os.path.join(self.path, name) for name in
+                os.listdir(self.path) if name.endswith('.zeml')]
+
+    def _get(self, key):
+        filename = self._filename(key)
+        try:
+            f = open(filename, 'rb')
+            try:
+                value = f.read()
+            finally:
+                f.close()
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+        return value
+
+    def _set(self, key, value):
+        filename = self._filename(key)
+        if self._count >= self.max_entries:
+            self._prune()
+        tmp = None
+        try:
+            fd, tmp = mkstemp(dir=self.path, suffix='.tmp')
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(value)
+            finally:
+                f.close()
+            exists = os.path.exists(filename)
+            if os.name == 'nt' and exists:
+                os.remove(filename)
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        if not exists:
+            self._count += 1
+
+    def _prune(self):
+        files = []
+        for filename in self._list_files():
+            try:
+                files.append((os.path.getmtime(filename), filename))
+            except OSError:
+                pass
+        files.sort()
+        for mtime, filename in files[:max(1, len(files) // 4)]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self._count = len(self._list_files())
+
+    def clear(self):
+        for filename in self._list_files():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self._count = 0
+
+
+#: Cache used by LiveJournalParser. Replace with set_render_cache. Zine
+#: sets it from the livejournal_parser/render_cache option.
+render_cache = MemoryRenderCache()
+
+
+def set_render_cache(cache):
+    """Make LiveJournalParser use `cache`, a RenderCache instance."""
+    global render_cache
+    render_cache = cache
+
+
+def make_render_cache(app):
+    """
+    Return the render cache the livejournal_parser/render_cache option asks
+    for: ``memory`` (the default), ``disk`` for a FileSystemRenderCache in
+    the instance folder, or ``none``. Anything else is logged and gets the
+    memory cache.
+    """
+    kind = app.cfg[CFG_RENDER_CACHE]
+    if kind == 'disk':
+        return FileSystemRenderCache(os.path.join(app.instance_folder,
+                                                  CACHE_FOLDER))
+    elif kind == 'none':
+        return NullRenderCache()
+    elif kind != 'memory':
+        log.warning(u'Unknown %s %r, not one of %s. Using the memory cache.'
+                    % (CFG_RENDER_CACHE, kind, u', '.join(RENDER_CACHES)))
+    return MemoryRenderCache()
 
 
 class LiveJournalParser(BaseParser):
@@ -206,8 +824,68 @@ class LiveJournalParser(BaseParser):
                     input_encoding='unicode',
                     initial_header_level=4)
 
+    def __init__(self, app):
+        BaseParser.__init__(self, app)
+        if app is not None:
+            set_render_cache(make_render_cache(app))
+
     def parse(self, input_data, reason):
-        intro_t, body_t = htmlize_markup(input_data, reason)
+        key = render_cache.make_key(input_data, reason)
+        data = render_cache.get(key)
+        if data is not None:
+            return load_parser_data(data)
+        body = self._parse(input_data, reason)
+        render_cache.set(key, dump_parser_data(body))
+        return body
+
+    def parse_many(self, inputs, reason, processes=None):
+        """
+        Parse a sequence of inputs for the same reason, as during an import.
+        Returns a list of trees, each the same as `parse` would return.
+        Identical inputs are parsed once. If `processes` is given, inputs
+        not found in the render cache are parsed in a pool of that many
+        worker processes.
+        """
+        allowed = allowed_tags_for(reason)
+        results = [None] * len(inputs)
+        pending = {} # key: [input, positions in results]
+        for counter, input_data in enumerate(inputs):
+            key = render_cache.make_key(input_data, reason)
+            if key in pending:
+                pending[key][1].append(counter)
+                continue
+            data = render_cache.get(key)
+            if data is not None:
+                results[counter] = load_parser_data(data)
+            else:
+                pending[key] = [input_data, [counter]]
+
+        keys = pending.keys()
+        if processes and len(keys) > 1:
+            from multiprocessing import Pool
+            pool = Pool(processes)
+            try:
+                dumps = pool.map(_parse_for_pool, [(pending[key][0], reason)
+                                                   for key in keys])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            dumps = []
+            for key in keys:
+                body = self._parse(pending[key][0], reason, allowed)
+                dumps.append(dump_parser_data(body))
+                results[pending[key][1][0]] = body
+
+        for key, data in zip(keys, dumps):
+            render_cache.set(key, data)
+            for counter in pending[key][1]:
+                if results[counter] is None:
+                    results[counter] = load_parser_data(data)
+        return results
+
+    def _parse(self, input_data, reason, allowed=None):
+        intro_t, body_t = htmlize_markup(input_data, reason, allowed)
         intro = sanitize(parse_zeml(intro_t))
         body = sanitize(parse_zeml(body_t))
         # The following complicated procedure is required only because
@@ -226,6 +904,13 @@ class LiveJournalParser(BaseParser):
         return body
 
 
+def _parse_for_pool(args):
+    """Worker for LiveJournalParser.parse_many. Returns serialized ZEML."""
+    input_data, reason = args
+    return dump_parser_data(LiveJournalParser(app=None)._parse(input_data,
+                                                               reason))
+
+
 def inject_style(req):
     """Add a link for the livejournal stylesheet to each page."""
     add_link('stylesheet', url_for('livejournal_parser/shared',
@@ -233,6 +918,8 @@ def inject_style(req):
 
 
 def setup(app, plugin):
+    app.add_config_var(CFG_RENDER_CACHE, forms.ChoiceField(
+        choices=[(kind, kind) for kind in RENDER_CACHES], default=u'memory'))
     app.add_parser('livejournal', LiveJournalParser)
     app.connect_event('after-request-setup', inject_style)
     app.add_shared_exports('livejournal_parser', SHARED_FILES)
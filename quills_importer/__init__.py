@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 import os.path
+import re
+import sys
 import xmlrpclib
-from time import strptime
+from tempfile import mkstemp
+from time import strptime, time
 from datetime import datetime
 from pytz import UTC
 from urllib2 import urlparse
@@ -17,6 +20,21 @@ from zine.utils.text import gen_slug, gen_timestamped_slug
 from zine.models import COMMENT_MODERATED, STATUS_PUBLISHED, STATUS_DRAFT
 import zine.models
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import resource
+except ImportError: # Not on Windows
+    resource = None
+
 try:
     from pygments import highlight
     from pygments.lexers import get_lexer_by_name
@@ -28,6 +46,12 @@ except ImportError:
 __version__ = '0.1'
 
 TEMPLATES = os.path.join(os.path.dirname(__file__), 'templates')
+STATE_FOLDER = 'quills_import' # In the instance folder
+
+#: Weblog entries asked of zine_export a call
+EXPORT_PAGE = 50
+#: Queue imports of more posts than this in parts
+POSTS_PER_DUMP = 1000
 
 PLONE_STATUS = {
     'published': STATUS_PUBLISHED,
@@ -42,13 +66,21 @@ PLONE_PARSERS = {
     }
 
 EXPORTSCRIPT = '''\
-# Get all Quills weblog entries on site
+##parameters=start=0, size=0
+# Get Quills weblog entries on site, oldest first: `size` of them from
+# `start`, or all of them if `size` is 0. Returns how many there are in
+# all along with the entries.
 
 catalog = context.portal_catalog
 dtool = context.portal_discussion
 
+items = catalog(Type=['Weblog Entry'], sort_on='created')
+total = len(items)
+if size:
+    items = items[start:start + size]
+
 result = []
-for item in catalog(Type=['Weblog Entry']):
+for item in items:
     entry = item.getObject()
     replies = []
     if dtool.isDiscussionAllowedFor(entry):
@@ -85,10 +117,9 @@ for item in catalog(Type=['Weblog Entry']):
         replies=replies,
         ))
 
-return result
+return dict(total=total, entries=result)
 '''
 
-
 def reunicode(value):
     if isinstance(value, str):
         return unicode(value, 'utf-8')
@@ -104,6 +135,238 @@ def parse_plone_date(value):
             datetime(*(strptime(value, '%Y-%m-%d %H:%M:%S')[:6])))
 
 
+def peak_rss():
+    """
+    Return the most memory this process has used so far, in megabytes, or
+    None where we can't tell.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1048576.0 # Bytes
+    return rss / 1024.0 # Kilobytes
+
+
+# The LiveJournal importer has the same metrics, since the two plugins are
+# installed on their own. Change both together.
+class ImportMetrics:
+    """
+    Wall time, requests, bytes received and items done in each phase of an
+    import, with the peak memory use at the end of each. Requests and bytes
+    are read from the `stats` of whatever makes them, given to `watch`. A
+    phase started again, as for each page of entries, adds to what it did
+    before.
+
+    >>> stats = dict(requests=0, bytes=0)
+    >>> metrics = ImportMetrics()
+    >>> metrics.watch(stats)
+    >>> metrics.start('export')
+    >>> stats['requests'] += 1; stats['bytes'] += 5000; metrics.add(12)
+    >>> metrics.start('posts')
+    >>> metrics.add(12)
+    >>> metrics.start('export')
+    >>> stats['requests'] += 1; stats['bytes'] += 2000; metrics.add(5)
+    >>> metrics.start('posts')
+    >>> metrics.add(5)
+    >>> metrics.finish()
+    >>> [(phase['name'], phase['requests'], phase['bytes'], phase['items'])
+    ...  for phase in metrics.phases]
+    [('export', 2, 7000, 17), ('posts', 0, 0, 17)]
+    """
+    def __init__(self):
+        self.sources = []
+        self.phases = []
+        self.current = None
+
+    def watch(self, stats):
+        self.sources.append(stats)
+        if self.current is not None:
+            #: Only what it does from now on counts towards this phase.
+            self.current['requests'] -= stats['requests']
+            self.current['bytes'] -= stats['bytes']
+
+    def start(self, name):
+        """Finish the phase under way, if any, and start the next."""
+        self.finish()
+        requests, bytes = self._totals()
+        self.current = {'name': name, 'started': time(), 'items': 0,
+                        'requests': -requests, 'bytes': -bytes}
+
+    def add(self, items=1):
+        """Count items done in the phase under way."""
+        self.current['items'] += items
+
+    def finish(self):
+        phase = self.current
+        if phase is None:
+            return
+        requests, bytes = self._totals()
+        phase['seconds'] = time() - phase.pop('started')
+        phase['requests'] += requests
+        phase['bytes'] += bytes
+        for earlier in self.phases:
+            if earlier['name'] == phase['name']:
+                for key in ('seconds', 'requests', 'bytes', 'items'):
+                    earlier[key] += phase[key]
+                phase = earlier
+                break
+        else:
+            self.phases.append(phase)
+        phase['items_per_second'] = phase['seconds'] and \
+                                    phase['items'] / phase['seconds'] or 0.0
+        phase['peak_rss'] = peak_rss()
+        self.current = None
+
+    def table(self):
+        """Return the phases as lines of an HTML table for the log."""
+        lines = [_(u'<table class="import-metrics">'),
+                 _(u'<tr><th>Phase</th><th>Time</th><th>Requests</th>'\
+                   u'<th>Received</th><th>Items</th><th>Items/s</th>'\
+                   u'<th>Peak memory</th></tr>')]
+        for phase in self.phases + [self._total()]:
+            if phase['items'] is None:
+                items = rate = u'-'
+            else:
+                items = u'%d' % phase['items']
+                rate = u'%.1f' % phase['items_per_second']
+            if phase['peak_rss'] is None:
+                memory = u'-'
+            else:
+                memory = u'%.1f MB' % phase['peak_rss']
+            lines.append(u'<tr><td>%s</td><td>%.1fs</td><td>%d</td>'\
+                         u'<td>%.1f kB</td><td>%s</td><td>%s</td>'\
+                         u'<td>%s</td></tr>' % (phase['name'],
+                phase['seconds'], phase['requests'], phase['bytes'] / 1024.0,
+                items, rate, memory))
+        lines.append(u'</table>')
+        return lines
+
+    def save(self, path):
+        """Write the phases and their total to `path` as JSON."""
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        f = open(path, 'w')
+        try:
+            json.dump({'phases': self.phases, 'total': self._total()}, f,
+                      indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    def _total(self):
+        total = {'name': _(u'Total'), 'seconds': 0.0, 'requests': 0,
+                 'bytes': 0, 'items': None, 'items_per_second': None,
+                 'peak_rss': peak_rss()}
+        for phase in self.phases:
+            for key in ('seconds', 'requests', 'bytes'):
+                total[key] += phase[key]
+        return total
+
+    def _totals(self):
+        requests = bytes = 0
+        for stats in self.sources:
+            requests += stats['requests']
+            bytes += stats['bytes']
+        return requests, bytes
+
+
+class CountedResponse:
+    """An HTTP response that counts the bytes read from it in `stats`."""
+    def __init__(self, response, stats):
+        self.response = response
+        self.stats = stats
+
+    def read(self, *args):
+        data = self.response.read(*args)
+        self.stats['bytes'] += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+class CountingTransport(xmlrpclib.SafeTransport):
+    """
+    XML-RPC transport, over HTTPS if `secure` or else HTTP, that counts
+    requests and bytes received in `stats`.
+    """
+    def __init__(self, secure=False):
+        xmlrpclib.SafeTransport.__init__(self)
+        self.secure = secure
+        self.stats = dict(requests=0, bytes=0)
+
+    def make_connection(self, host):
+        if self.secure:
+            return xmlrpclib.SafeTransport.make_connection(self, host)
+        return xmlrpclib.Transport.make_connection(self, host)
+
+    def parse_response(self, response):
+        self.stats['requests'] += 1
+        return xmlrpclib.SafeTransport.parse_response(self,
+                                        CountedResponse(response, self.stats))
+
+
+class PostSpool:
+    """
+    The posts of an import, with their comments, kept in a file in `folder`
+    until they go to the import queue, so that a big blog needn't fit in
+    memory. Only where each post is in the file is kept in memory. Tags and
+    authors are stored by name and looked up in `tags` and `authors` when a
+    post is read back, so posts keep sharing them. The file gets a name of
+    its own, so imports running at once don't share it, and is deleted by
+    `remove`.
+    """
+    def __init__(self, folder, tags, authors, prefix=''):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        fd, self.path = mkstemp(suffix='.spool', prefix=prefix, dir=folder)
+        self.file = os.fdopen(fd, 'w+b')
+        self.tags = tags
+        self.authors = authors
+        self.index = {} # Key: offset of post
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, key, post):
+        """File `post` under `key`, replacing any post already there."""
+        self.file.seek(0, 2)
+        self.index[key] = self.file.tell()
+        pickler = pickle.Pickler(self.file, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self._persistent_id
+        pickler.dump(post)
+
+    def keys(self):
+        """Return the keys of the posts, in order."""
+        return sorted(self.index)
+
+    def post(self, key):
+        """Return the post filed under `key`."""
+        self.file.seek(self.index[key])
+        unpickler = pickle.Unpickler(self.file)
+        unpickler.persistent_load = self._persistent_load
+        return unpickler.load()
+
+    def remove(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _persistent_id(self, obj):
+        if isinstance(obj, Author):
+            return ('author', obj.username)
+        elif isinstance(obj, Tag):
+            return ('tag', obj.name)
+        return None
+
+    def _persistent_load(self, pid):
+        kind, name = pid
+        if kind == 'author':
+            return self.authors[name]
+        return self.tags[name]
+
+
 def is_valid_plone_password(message=None):
     """
     Validates Plone password. Our handler requires that the password not have
@@ -197,115 +460,187 @@ class QuillsImporter(Importer):
             urlnetloc = '%s:%s@%s' % (username, password, urlnetloc)
         useblogurl = urlparse.urlunsplit((urlparts.scheme, urlnetloc, urlpath,
                                           '', ''))
-        conn = xmlrpclib.ServerProxy(useblogurl)
+        transport = CountingTransport(secure=urlparts.scheme == 'https')
+        conn = xmlrpclib.ServerProxy(useblogurl, transport=transport)
+        #: Where the time goes, for the table at the end.
+        metrics = ImportMetrics()
+        metrics.watch(transport.stats)
+        metrics.start('connect')
         title = conn.Title()
-        data = conn.zine_export()
-        yield _(u'<p>Got data. Parsing for weblog entries and replies.</p>')
 
         tags = {}
-        posts = {}
         authors = {}
-
-        yield _(u'<ol>')
-        for entry in data:
-            itemtags = []
-            for tag in entry['tags']:
-                if tag in tags:
-                    itemtags.append(tags[tag])
+        #: Posts wait on disk until they are queued. They are filed by where
+        #: they came in the export, each entry once.
+        spool = PostSpool(os.path.join(self.app.instance_folder, STATE_FOLDER),
+                          tags, authors,
+                          '%s.' % re.sub(r'\W', '_', urlparts.netloc))
+        order = {}
+        try:
+            start = 0
+            while True:
+                metrics.start('zine_export')
+                if start == 0:
+                    try:
+                        data = conn.zine_export(start, EXPORT_PAGE)
+                    except xmlrpclib.Fault:
+                        #: A zine_export from before it took parameters. It
+                        #: sends every entry at once.
+                        yield _(u'<p>Your zine_export script sends all '\
+                                u'entries at once, which large sites may not '\
+                                u'manage. Please replace it with the one on '\
+                                u'the import page.</p>')
+                        data = conn.zine_export()
                 else:
-                    newtag = Tag(gen_slug(tag), tag)
-                    tags[tag] = newtag
-                    itemtags.append(newtag)
-            if entry['author'] in authors:
-                author = authors[entry['author']]
-            else:
-                author = Author(entry['author'], '', '')
-                authors[entry['author']] = author
-            status = PLONE_STATUS.get(entry['status'], STATUS_PUBLISHED)
-            body = reunicode(entry['body'])
-            description = reunicode(entry['description'])
-            subject = reunicode(entry['title'])
-            parser = PLONE_PARSERS.get(entry['format'], 'zeml')
-            pub_date = parse_plone_date(entry['date'])
-
-            if description:
-                #: Assume description is text/plain. Anything else is unlikely
-                if parser in ['zeml', 'html']:
-                    body = u'<intro><p>%s</p></intro>%s' % (description, body)
+                    data = conn.zine_export(start, EXPORT_PAGE)
+                if isinstance(data, dict):
+                    total = data['total']
+                    entries = data['entries']
                 else:
-                    # We don't know how this parser works, so just insert
-                    # description before body, with a blank line in between
-                    body = u'%s\n\n%s' % (description, body)
-
-            comments = {}
-
-            for comment in entry['replies']:
-                c_body = reunicode(comment['body'])
-                c_author = comment['author']
-                if c_author in authors:
-                    c_author = authors[c_author]
-                #: Fix for Jace's anon comments hack
-                elif c_author.startswith('!'):
-                    c_author = c_author[1:]
-                c_body = reunicode(comment['body'])
-                c_subject = reunicode(comment['title'])
-                if c_subject:
-                    c_body = '%s\n\n%s' % (c_subject, c_body)
-
-                comments[comment['id']] = Comment(
-                    author = c_author,
-                    body = c_body,
-                    pub_date = parse_plone_date(
-                                            comment['date']).astimezone(UTC),
-                    author_email = None,
-                    author_url = None,
-                    remote_addr = None,
-                    parent = comment['parent'],
-                    parser = 'text',
-                    status = COMMENT_MODERATED
-                    )
-
-            # Re-thread comments
-            for comment in comments.values():
-                comment.parent = comments.get(comment.parent, None)
-
-
-            posts[entry['id']] = Post(
-                slug=gen_timestamped_slug(entry['id'],
-                                          'entry', pub_date),
-                title=subject,
-                link=entry['url'],
-                pub_date=pub_date.astimezone(UTC),
-                author=authors[entry['author']],
-                intro=u'',
-                body=body,
-                tags=itemtags,
-                categories=[],
-                comments=comments.values(),
-                comments_enabled=entry['allow_comments'],
-                pings_enabled=True,
-                uid=entry['id'],
-                parser=parser,
-                content_type='entry',
-                status=status
-                )
-            yield _(u'<li><strong>%s</strong> (by %s; %d comments)</li>') % (
-                subject, author.username, len(comments))
-
-        yield _(u'</ol>')
-        self.enqueue_dump(Blog(
-            title,
-            blogurl,
-            '',
-            'en',
-            tags.values(),
-            [],
-            posts.values(),
-            authors.values()))
+                    total = len(data)
+                    entries = data
+                metrics.add(len(entries))
+                if not entries:
+                    break
+                yield _(u'<p>Got entries %d to %d of %d.</p>') % (
+                    start + 1, start + len(entries), total)
+                metrics.start('posts')
+                yield _(u'<ol start="%d">') % (start + 1)
+                for entry in entries:
+                    post = self._make_post(entry, tags, authors)
+                    spool.add(order.setdefault(entry['id'], len(order)), post)
+                    yield _(u'<li><strong>%s</strong> (by %s; %d comments)'\
+                            u'</li>') % (post.title, post.author.username,
+                                         len(post.comments))
+                    metrics.add()
+                yield _(u'</ol>')
+                start += len(entries)
+                if start >= total:
+                    break
+
+            metrics.start('enqueue_dump')
+            #: Zine takes a whole blog at a time, so a big blog is queued in
+            #: parts, each read back from the spool as it is queued.
+            keys = spool.keys()
+            parts = max(1, (len(keys) + POSTS_PER_DUMP - 1) // POSTS_PER_DUMP)
+            for part in range(parts):
+                part_title = title
+                if parts > 1:
+                    part_title = u'%s (%d/%d)' % (title, part + 1, parts)
+                    yield _(u'<p>Queueing part %d of %d...</p>') % (part + 1,
+                                                                    parts)
+                part_keys = keys[part * POSTS_PER_DUMP:
+                                 (part + 1) * POSTS_PER_DUMP]
+                self.enqueue_dump(Blog(
+                    part_title,
+                    blogurl,
+                    '',
+                    'en',
+                    tags.values(),
+                    [],
+                    [spool.post(key) for key in part_keys],
+                    authors.values()))
+                metrics.add(len(part_keys))
+        finally:
+            spool.remove()
         flash(_(u'Added imported items to queue.'))
-
+        metrics.finish()
+
+        for line in metrics.table():
+            yield line
+        metrics_path = os.path.join(self.app.instance_folder, STATE_FOLDER,
+                                    '%s.metrics.json' % re.sub(r'\W', '_',
+                                                               urlparts.netloc))
+        metrics.save(metrics_path)
+        yield _(u'<p>These figures were saved to %s.</p>') % metrics_path
         yield _(u'<p><strong>All done.</strong></p>')
 
+    def _make_post(self, entry, tags, authors):
+        """
+        Return a Post for an entry from zine_export, with its comments. Tags
+        and authors are shared through the `tags` and `authors` dicts.
+        """
+        itemtags = []
+        for tag in entry['tags']:
+            if tag in tags:
+                itemtags.append(tags[tag])
+            else:
+                newtag = Tag(gen_slug(tag), tag)
+                tags[tag] = newtag
+                itemtags.append(newtag)
+        if entry['author'] in authors:
+            author = authors[entry['author']]
+        else:
+            author = Author(entry['author'], '', '')
+            authors[entry['author']] = author
+        status = PLONE_STATUS.get(entry['status'], STATUS_PUBLISHED)
+        body = reunicode(entry['body'])
+        description = reunicode(entry['description'])
+        subject = reunicode(entry['title'])
+        parser = PLONE_PARSERS.get(entry['format'], 'zeml')
+        pub_date = parse_plone_date(entry['date'])
+
+        if description:
+            #: Assume description is text/plain. Anything else is unlikely
+            if parser in ['zeml', 'html']:
+                body = u'<intro><p>%s</p></intro>%s' % (description, body)
+            else:
+                # We don't know how this parser works, so just insert
+                # description before body, with a blank line in between
+                body = u'%s\n\n%s' % (description, body)
+
+        comments = {}
+
+        for comment in entry['replies']:
+            c_body = reunicode(comment['body'])
+            c_author = comment['author']
+            if c_author in authors:
+                c_author = authors[c_author]
+            #: Fix for Jace's anon comments hack
+            elif c_author.startswith('!'):
+                c_author = c_author[1:]
+            c_body = reunicode(comment['body'])
+            c_subject = reunicode(comment['title'])
+            if c_subject:
+                c_body = '%s\n\n%s' % (c_subject, c_body)
+
+            comments[comment['id']] = Comment(
+                author = c_author,
+                body = c_body,
+                pub_date = parse_plone_date(
+                                        comment['date']).astimezone(UTC),
+                author_email = None,
+                author_url = None,
+                remote_addr = None,
+                parent = comment['parent'],
+                parser = 'text',
+                status = COMMENT_MODERATED
+                )
+
+        # Re-thread comments
+        for comment in comments.values():
+            comment.parent = comments.get(comment.parent, None)
+
+        return Post(
+            slug=gen_timestamped_slug(entry['id'],
+                                      'entry', pub_date),
+            title=subject,
+            link=entry['url'],
+            pub_date=pub_date.astimezone(UTC),
+            author=author,
+            intro=u'',
+            body=body,
+            tags=itemtags,
+            categories=[],
+            comments=comments.values(),
+            comments_enabled=entry['allow_comments'],
+            pings_enabled=True,
+            uid=entry['id'],
+            parser=parser,
+            content_type='entry',
+            status=status
+            )
+
     def configure(self, request):
         form = QuillsImportForm()
 
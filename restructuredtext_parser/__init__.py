@@ -1,22 +1,39 @@
 import os.path
-from docutils.core import publish_parts
+from tempfile import mkstemp
+from threading import Lock
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+import docutils
+from docutils.core import Publisher
+from docutils.io import StringInput, StringOutput
 from zine.i18n import _
 from zine.api import get_application, url_for
 from zine.views.admin import flash, render_admin_response
 from zine.privileges import BLOG_ADMIN, require_privilege
 from zine.parsers import BaseParser
 from zine.utils import forms
-from zine.utils.zeml import parse_html
+from zine.utils.zeml import parse_html, dump_parser_data, load_parser_data
 from zine.utils.validators import ValidationError, check
 
 try:
     import use_pygments_for_docutils
 except ImportError: # No Pygments
-    pass
+    use_pygments_for_docutils = None
+try:
+    from pygments import __version__ as pygments_version
+except ImportError:
+    pygments_version = None
 
 TEMPLATES = os.path.join(os.path.dirname(__file__), 'templates')
 CFG_HEADER_LEVEL = 'restructuredtext_parser/initial_header_level'
 
+#: Folder in the instance folder for cached HTML
+CACHE_FOLDER = 'restructuredtext_cache'
+#: Bump this to invalidate cached HTML after changing how it is produced
+CACHE_VERSION = '1'
+
 def is_valid_header_level(message=None):
     """Ensure level is between 1 and 6, inclusive."""
     if message is None:
@@ -38,14 +55,23 @@ def show_restructuredtext_config(req):
     form = ConfigurationForm(initial=dict(
             initial_header_level=req.app.cfg[CFG_HEADER_LEVEL]))
 
+    cache = req.app.parsers['restructuredtext'].cache
+
     if req.method == 'POST' and form.validate(req.form):
-        if form.has_changed:
+        if 'clear_cache' in req.form:
+            cache.clear()
+            flash(_('reStructuredText cache cleared.'), 'ok')
+        elif form.has_changed:
             req.app.cfg.change_single(CFG_HEADER_LEVEL,
                                                 form['initial_header_level'])
+            req.app.parsers['restructuredtext'].reset()
             flash(_('reStructuredText Parser settings saved.'), 'ok')
     return render_admin_response('admin/restructuredtext_options.html',
                                  'options.restructuredtext',
-                                 form=form.as_widget())
+                                 form=form.as_widget(),
+                                 cache=cache.stats,
+                                 highlighting=use_pygments_for_docutils and
+                                              use_pygments_for_docutils.stats)
 
 
 def add_config_link(req, navigation_bar):
@@ -58,6 +84,136 @@ def add_config_link(req, navigation_bar):
                                     _('reStructuredText')))
 
 
+class HTMLCache(object):
+    """
+    On-disk cache of parsed documents, one file per document in `path`.
+    Keys are a hash of the input, the docutils settings it was parsed with,
+    and the docutils and Pygments versions. A file's modification time
+    records its last use, and when the files add up to more than `max_size`
+    bytes the least recently used are removed until a quarter of the space
+    is free.
+    """
+
+    def __init__(self, path, max_size=20 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._entries, self._size = self._usage()
+
+    def make_key(self, input_data, settings):
+        """Return the cache key for `input_data` parsed with `settings`."""
+        keyhash = sha1('%s\0%s\0%s\0%r\0' % (CACHE_VERSION,
+                                              docutils.__version__,
+                                              pygments_version,
+                                              sorted(settings.items())))
+        keyhash.update(input_data.encode('utf-8'))
+        return keyhash.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.zeml')
+
+    def _list_files(self):
+        return [os.path.join(self.path, name) for name in
+                os.listdir(self.path) if name.endswith('.zeml')]
+
+    def _usage(self):
+        entries = size = 0
+        for filename in self._list_files():
+            try:
+                size += os.path.getsize(filename)
+                entries += 1
+            except OSError:
+                pass
+        return entries, size
+
+    def get(self, key):
+        """Return the cached data for `key`, or None."""
+        filename = self._filename(key)
+        try:
+            f = open(filename, 'rb')
+            try:
+                value = f.read()
+            finally:
+                f.close()
+            os.utime(filename, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Store `value` under `key`."""
+        if self._size + len(value) > self.max_size:
+            self._prune(self.max_size * 3 // 4 - len(value))
+        filename = self._filename(key)
+        try:
+            old_size = os.path.getsize(filename)
+        except OSError:
+            old_size = None
+        tmp = None
+        try:
+            fd, tmp = mkstemp(dir=self.path, suffix='.tmp')
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(value)
+            finally:
+                f.close()
+            if os.name == 'nt' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        if old_size is None:
+            self._entries += 1
+            self._size += len(value)
+        else:
+            self._size += len(value) - old_size
+
+    def _prune(self, target_size):
+        files = []
+        for filename in self._list_files():
+            try:
+                files.append((os.path.getmtime(filename),
+                              os.path.getsize(filename), filename))
+            except OSError:
+                pass
+        files.sort()
+        size = sum([filesize for mtime, filesize, filename in files])
+        for mtime, filesize, filename in files:
+            if size <= target_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            size -= filesize
+        self._entries, self._size = self._usage()
+
+    def clear(self):
+        """Remove all cached documents."""
+        for filename in self._list_files():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self.hits = self.misses = 0
+        self._entries, self._size = self._usage()
+
+    @property
+    def stats(self):
+        """Dictionary of entries, size in bytes, hits, misses and hit rate."""
+        total = self.hits + self.misses
+        return dict(entries=self._entries, size=self._size, hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=total and float(self.hits) / total or 0.0)
+
+
 class ReStructuredTextParser(BaseParser):
     """A reStructuredText parser."""
 
@@ -69,18 +225,80 @@ class ReStructuredTextParser(BaseParser):
                     input_encoding='unicode',
                     doctile_xform=0)
 
-    def parse(self, input_data, reason):
+    def __init__(self, app):
+        BaseParser.__init__(self, app)
+        #: Publishers as (is_comment, header_level): Publisher
+        self._publishers = {}
+        self._lock = Lock()
+        if app is None:
+            self.cache = None
+        else:
+            self.cache = HTMLCache(os.path.join(app.instance_folder,
+                                                CACHE_FOLDER))
+
+    def reset(self):
+        """Drop the publishers kept for header levels no longer in use."""
+        header_level = get_application().cfg[CFG_HEADER_LEVEL]
+        self._lock.acquire()
+        try:
+            for key in self._publishers.keys():
+                if key[1] != header_level:
+                    del self._publishers[key]
+        finally:
+            self._lock.release()
+
+    def _effective_settings(self, is_comment, header_level):
         usesettings = dict(self.settings)
 
-        if reason == 'comment':
+        if is_comment:
             usesettings['file_insertion_enabled'] = 0
-        usesettings['initial_header_level'] = get_application().cfg[
-                                                            CFG_HEADER_LEVEL]
+        usesettings['initial_header_level'] = header_level
+        return usesettings
+
+    def _make_publisher(self, is_comment, header_level):
+        """
+        Make a publisher with its settings, reader, parser and writer set up.
+        This is what makes `publish_parts` slow, so it is done once for each
+        combination of settings and the publisher reused for every document.
+        """
+        usesettings = self._effective_settings(is_comment, header_level)
+
+        publisher = Publisher(source_class=StringInput,
+                              destination_class=StringOutput)
+        publisher.set_components('standalone', 'restructuredtext', 'html')
+        publisher.process_programmatic_settings(None, usesettings, None)
+        return publisher
+
+    def parse(self, input_data, reason):
+        # Read on every parse, so a header level changed outside the
+        # options page, or by another process, is used at once.
+        key = (reason == 'comment', get_application().cfg[CFG_HEADER_LEVEL])
+
+        if self.cache is not None:
+            cache_key = self.cache.make_key(input_data,
+                                            self._effective_settings(*key))
+            data = self.cache.get(cache_key)
+            if data is not None:
+                return load_parser_data(data)
 
-        parts = publish_parts(input_data, writer_name='html',
-                              settings_overrides=usesettings)
+        # Readers and writers keep the document being processed on
+        # themselves, so only one thread may use a publisher at a time.
+        self._lock.acquire()
+        try:
+            publisher = self._publishers.get(key)
+            if publisher is None:
+                publisher = self._publishers[key] = self._make_publisher(*key)
+            publisher.set_source(input_data, None)
+            publisher.set_destination(None, None)
+            publisher.publish()
+            html_body = publisher.writer.parts['html_body']
+        finally:
+            self._lock.release()
 
-        return parse_html(parts['html_body'])
+        body = parse_html(html_body)
+        if self.cache is not None:
+            self.cache.set(cache_key, dump_parser_data(body))
+        return body
 
 
 def setup(app, plugin):
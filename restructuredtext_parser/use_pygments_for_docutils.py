@@ -51,23 +51,62 @@ VARIANTS = {
     # 'linenos': HtmlFormatter(noclasses=INLINESTYLES, linenos=True),
 }
 
+# Number of lexers and of highlighted code blocks to remember
+LEXER_CACHE_SIZE = 200
+HIGHLIGHT_CACHE_SIZE = 500
+
 
 from docutils import nodes
 from docutils.parsers.rst import directives
 
+from time import time
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
 from pygments import highlight
 from pygments.lexers import get_lexer_by_name, TextLexer
 
+# Lexers as alias: lexer, and highlighted code as
+# (alias, variant, code hash): HTML. Both are emptied when full.
+_lexers = {}
+_highlighted = {}
+
+# Code blocks seen, blocks actually highlighted and seconds spent doing so
+stats = dict(blocks=0, highlighted=0, seconds=0.0)
+
+def get_lexer(alias):
+    """Return a lexer for `alias`, reusing the lexers made before."""
+    lexer = _lexers.get(alias)
+    if lexer is None:
+        try:
+            lexer = get_lexer_by_name(alias)
+        except ValueError:
+            # no lexer found - use the text one instead of an exception
+            lexer = TextLexer()
+        if len(_lexers) >= LEXER_CACHE_SIZE:
+            _lexers.clear()
+        _lexers[alias] = lexer
+    return lexer
+
 def pygments_directive(name, arguments, options, content, lineno,
                        content_offset, block_text, state, state_machine):
-    try:
-        lexer = get_lexer_by_name(arguments[0])
-    except ValueError:
-        # no lexer found - use the text one instead of an exception
-        lexer = TextLexer()
     # take an arbitrary option if more than one is given
-    formatter = options and VARIANTS[options.keys()[0]] or DEFAULT
-    parsed = highlight(u'\n'.join(content), lexer, formatter)
+    variant = options and options.keys()[0] or None
+    code = u'\n'.join(content)
+    key = (arguments[0], variant, sha1(code.encode('utf-8')).digest())
+    stats['blocks'] += 1
+    parsed = _highlighted.get(key)
+    if parsed is None:
+        formatter = variant and VARIANTS[variant] or DEFAULT
+        start = time()
+        parsed = highlight(code, get_lexer(arguments[0]), formatter)
+        stats['seconds'] += time() - start
+        stats['highlighted'] += 1
+        if len(_highlighted) >= HIGHLIGHT_CACHE_SIZE:
+            _highlighted.clear()
+        _highlighted[key] = parsed
     return [nodes.raw('', parsed, format='html')]
 
 pygments_directive.arguments = (1, 0, 1)